@@ -0,0 +1,312 @@
+# =============================================================================
+# bmle
+# G4Pipeline: Batch.py
+# Runs the pipeline over many genomes at once, sharing one pool of worker
+# processes and resuming where a previous batch stopped
+# =============================================================================
+
+# Estimated peak memory of a stage, as a multiple of the size of its inputs
+MEMORY_FACTOR = 5
+
+SUMMARY_COLUMNS = ['genome', 'status', 'sequences', 'gplexes', 'non-alignments', 'overlapping genes', 'overlapping nals',
+	'overlapping gplexes', 'upstream', 'overlap', 'downstream', 'no annotation', 'mean distance (bp)']
+
+def main(manifestPath, outDir=None, jobs=1, memory=None, force=False):
+	"""Run the pipeline over every genome of a manifest.
+
+	Stages of all genomes are scheduled on one pool of processes; the stages of each genome
+	run in order, and a stage is only started if the processes and estimated memory of every
+	running stage fit in jobs and the memory budget; genomes whose next stage doesn't fit wait
+	without holding back the genomes after them. A genome's 'workers' setting is capped at jobs,
+	and each stage counts as that many processes. The state of every stage is recorded as it finishes, so a
+	batch that is interrupted resumes where it stopped when it is run again.
+
+	:param manifestPath: path to the JSON-formatted manifest (see loadManifest())
+	:param outDir: directory where the batch state and combined summary are written (default=directory of manifestPath)
+	:param jobs: max number of processes used by all running stages (default=1)
+	:param memory: memory budget (in MB) of all running stages (default=80% of the available memory, if known)
+	:param force: if True, reruns every stage of every genome (default=False)
+	:return: a dict mapping each genome to its status ('done' or 'failed')
+	"""
+	import os
+	from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+	import Pipeline
+	print('\nRunning batch...')
+
+	if outDir is None: outDir = os.path.dirname(os.path.abspath(manifestPath))
+	os.makedirs(outDir, exist_ok=True)
+	statePath = os.path.join(outDir, 'batch_state.json')
+	genomes = loadManifest(manifestPath)
+	state = {} if force else loadState(statePath)
+
+	# Queues every stage that hasn't finished, discarding the state of genomes whose settings changed
+	pending = {}
+	stages = {}
+	reports = {}
+	for name, config in genomes.items():
+		signature = _signature(config)
+		if state.get(name, {}).get('config') != signature:
+			state[name] = {'config': signature, 'status': 'pending', 'stages': {}}
+		settings = Pipeline.prepare(config)
+		stages[name] = {stage['name']: stage for stage in Pipeline.buildStages(settings)}
+		pending[name] = [stage for stage in stages[name] if state[name]['stages'].get(stage) != 'done']
+		reports[name] = []
+		if pending[name]: state[name]['status'] = 'pending'
+	saveState(statePath, state)
+
+	if memory is None:
+		available = _availableMemory()
+		memory = available * 0.8 / 1000000 if available else None
+	budget = memory * 1000000 if memory else None
+
+	jobs = max(1, jobs)
+	running = {}		# future -> (genome, stage, estimated memory, processes)
+	with ProcessPoolExecutor(max_workers=jobs) as pool:
+		while True:
+			# Starts the next stage of every idle genome that fits in the free processes and memory
+			busy = set(genome for genome, _, _, _ in running.values())
+			for name in genomes:
+				used = sum(n for _, _, _, n in running.values())
+				if used >= jobs: break
+				if name in busy or not pending[name]: continue
+				stageName = pending[name][0]
+				processes = _processes(genomes[name], jobs)
+				estimate = _estimate(stages[name][stageName]) * (2 if processes > 1 else 1)	# workers hold another copy of the shards
+				inUse = sum(est for _, _, est, _ in running.values())
+				if running and (used + processes > jobs or (budget is not None and inUse + estimate > budget)): continue	# a smaller stage of a later genome may still fit
+				print('Starting ' + stageName + ' of ' + name + '...')
+				future = pool.submit(_runStage, dict(genomes[name], workers=processes), stageName, force)
+				running[future] = (name, stageName, estimate, processes)
+				pending[name].pop(0)
+			if not running: break
+
+			# Records every stage that finishes
+			done, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				name, stageName, _, _ = running.pop(future)
+				try:
+					reports[name].extend(future.result())
+					state[name]['stages'][stageName] = 'done'
+					if not pending[name]: state[name]['status'] = 'done'
+					print('Finished ' + stageName + ' of ' + name)
+				except Exception as e:
+					state[name]['stages'][stageName] = 'failed'
+					state[name]['status'] = 'failed'
+					state[name]['error'] = stageName + ': ' + repr(e)
+					pending[name] = []
+					print('Failed ' + stageName + ' of ' + name + ': ' + repr(e))
+				saveState(statePath, state)
+				if state[name]['status'] != 'pending' and reports[name]: _writeReport(genomes[name], reports[name])
+
+	summaryPath = os.path.join(outDir, 'batch_summary.tsv')
+	summarize(genomes, stages, state, summaryPath)
+	print('Finished writing summary to ' + summaryPath + '\nFinished!\n')
+	return {name: state[name]['status'] for name in genomes}
+
+def loadManifest(manifestPath):
+	"""Load the genomes of a batch.
+
+	The manifest is a JSON object with an optional 'defaults' object of settings shared by
+	every genome, and a 'genomes' object mapping each genome's name to its own settings
+	(see Pipeline.DEFAULTS). 'seqidIndex' must be set, as the user can't be asked for it.
+
+	:param manifestPath: path to the JSON-formatted manifest
+	:return: a dict mapping each genome's name to its settings
+	"""
+	import os
+	import json
+	import Pipeline
+
+	with open(manifestPath, 'r') as f: manifest = json.load(f)
+	unknown = set(manifest) - {'defaults', 'genomes'}
+	if unknown: raise ValueError('Unknown sections in ' + manifestPath + ': ' + ', '.join(sorted(unknown)))
+
+	genomes = {}
+	for name, entry in manifest.get('genomes', {}).items():
+		config = dict(manifest.get('defaults', {}))
+		config.update(entry)
+		unknown = set(config) - set(Pipeline.DEFAULTS)
+		if unknown: raise ValueError('Unknown settings for ' + name + ' in ' + manifestPath + ': ' + ', '.join(sorted(unknown)))
+		if config.get('seqidIndex') is None: raise ValueError('Missing seqidIndex for ' + name + ' in ' + manifestPath)
+		config.setdefault('prefix', os.path.join(os.path.dirname(os.path.abspath(manifestPath)), name))
+		genomes[name] = config
+	if not genomes: raise ValueError('No genomes in ' + manifestPath)
+	return genomes
+
+def loadState(statePath):
+	"""Load the state of a previous batch.
+
+	:param statePath: path to the JSON-formatted state file
+	:return: a dict mapping each genome to its state, or an empty dict if there was no previous batch
+	"""
+	import json
+
+	try:
+		with open(statePath, 'r') as f: return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+def saveState(statePath, state):
+	"""Save the state of a batch, replacing the previous state file in one step.
+
+	:param statePath: path to the JSON-formatted state file
+	:param state: a dict mapping each genome to its state
+	:return: nothing
+	"""
+	import os
+	import json
+
+	tempPath = statePath + '.tmp'
+	with open(tempPath, 'w') as f: json.dump(state, f, indent='\t')
+	os.replace(tempPath, statePath)
+
+def summarize(genomes, stages, state, summaryPath):
+	"""Write a table comparing the results of every genome.
+
+	:param genomes: a dict mapping each genome's name to its settings
+	:param stages: a dict mapping each genome's name to a dict of its stages, as generated by Pipeline.buildStages()
+	:param state: a dict mapping each genome to its state
+	:param summaryPath: path where the tab-separated table should be written
+	:return: nothing
+	"""
+	import os
+	from NearestAnnot import readData
+	from Utils import loadFastaIndex
+
+	with open(summaryPath, 'w') as summaryFile:
+		summaryFile.write('\t'.join(SUMMARY_COLUMNS) + '\n')
+		for name, config in genomes.items():
+			row = [name, state[name]['status']] + [''] * (len(SUMMARY_COLUMNS)-2)
+			if state[name]['status'] == 'done':
+				outputs = {stageName: stage['outputs'] for stageName, stage in stages[name].items()}
+				gplexPath = (outputs.get('reformatBED') or outputs.get('G4Finder'))[0]
+				row[2] = len(loadFastaIndex(os.path.join(config['prefix'], config['fasta'])))
+				row[3] = _countEntries(gplexPath)
+				row[4] = _countEntries(outputs['NonAlignments'][0])
+				row[5:8] = [_countEntries(path) for path in outputs['GeneOverlap'][:3]]
+
+				# Locations of gplexes relative to their nearest annotations
+				locations = {'Upstream': 0, 'Overlap': 0, 'Downstream': 0, 'n/a': 0}
+				distances = []
+				for item in readData(outputs['NearestAnnot-gplex'][0]):
+					locations[item[6]] += 1
+					if item[6] not in ('Overlap', 'n/a'): distances.append(abs(item[9]))
+				row[8:12] = [locations[location] for location in ('Upstream', 'Overlap', 'Downstream', 'n/a')]
+				row[12] = round(sum(distances) / len(distances), 2) if distances else 'n/a'
+			summaryFile.write('\t'.join(str(x) for x in row) + '\n')
+
+def _runStage(config, stageName, force):
+	"""Run a single stage of a genome in a worker process.
+
+	The stage's output is written to '<prefix>/logs/<stage>.log' rather than interleaved with other stages.
+
+	:param config: the settings of the genome
+	:param stageName: name of the stage, as generated by Pipeline.buildStages()
+	:param force: if True, runs the stage regardless of its stamp
+	:return: the records of the stage's instrumentation (see Instrument.report)
+	"""
+	import os
+	import contextlib
+	import Pipeline
+	import Instrument
+
+	settings = Pipeline.prepare(config)
+	stage = next(stage for stage in Pipeline.buildStages(settings) if stage['name'] == stageName)
+	logDir = os.path.join(settings['prefix'], 'logs')
+	os.makedirs(logDir, exist_ok=True)
+	Instrument.reset()
+	with open(os.path.join(logDir, stageName + '.log'), 'w') as log, contextlib.redirect_stdout(log):
+		Pipeline.runStage(stage, settings, force)
+	return Instrument.report['stages']
+
+def _writeReport(config, records):
+	"""Write the instrumentation records of every stage of a genome to '<prefix>/run_report.json'.
+
+	:param config: the settings of the genome
+	:param records: the records returned by every stage
+	:return: nothing
+	"""
+	import os
+	import Instrument
+
+	Instrument.report['stages'] = records
+	Instrument.writeReport(os.path.join(config['prefix'], 'run_report.json'))
+	Instrument.reset()
+
+def _estimate(stage):
+	"""Estimate the peak memory of a stage.
+
+	:param stage: a stage generated by Pipeline.buildStages()
+	:return: estimated memory in bytes
+	"""
+	import os
+
+	return MEMORY_FACTOR * sum(os.path.getsize(path) for path in stage['inputs'] if os.path.exists(path))
+
+def _processes(config, jobs):
+	"""Count the processes that a stage of a genome may use.
+
+	:param config: the settings of the genome
+	:param jobs: max number of processes of the batch
+	:return: the genome's 'workers' setting (every CPU if 0), capped at jobs
+	"""
+	import os
+	import Pipeline
+
+	workers = config.get('workers', Pipeline.DEFAULTS['workers'])
+	if workers is None or workers <= 0: workers = os.cpu_count() or 1
+	return max(1, min(workers, jobs))
+
+def _availableMemory():
+	"""Get the amount of memory available to new processes.
+
+	:return: available memory in bytes, or None if it can't be determined
+	"""
+	try:
+		with open('/proc/meminfo', 'r') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'): return int(line.split()[1]) * 1024
+	except (OSError, ValueError, IndexError):
+		pass
+	return None
+
+def _signature(config):
+	"""Summarize the settings of a genome, to detect when they change between batches.
+
+	:param config: the settings of the genome
+	:return: a string
+	"""
+	import json
+	return json.dumps(config, sort_keys=True)
+
+def _countEntries(gffPath):
+	"""Count the entries of a GFF file.
+
+	:param gffPath: path to the GFF file
+	:return: number of lines that aren't headers
+	"""
+	from Utils import openFile
+
+	with openFile(gffPath, 'r') as f: return sum(1 for line in f if not line.startswith('#') and line.strip())
+
+# =============================================================================
+
+if __name__ == '__main__':
+	import sys
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Run the G4 annotation pipeline over every genome of a manifest.')
+	parser.add_argument('manifestPath',
+						help='path to the JSON-formatted manifest of genomes')
+	parser.add_argument('--outDir',
+						help='directory where the batch state and combined summary are written (default=directory of the manifest)')
+	parser.add_argument('--jobs', type=int, action='store', default=1,
+						help='max number of processes used by all running stages, counting each genome\'s workers (default=1)')
+	parser.add_argument('--memory', type=float, action='store', default=None,
+						help='memory budget (in MB) of all running stages (default=80%% of the available memory)')
+	parser.add_argument('--force', action='store_true',
+						help='rerun every stage of every genome, ignoring the state of previous batches')
+	args = parser.parse_args()
+
+	statuses = main(args.manifestPath, args.outDir, args.jobs, args.memory, args.force)
+	if any(status != 'done' for status in statuses.values()): sys.exit(1)
@@ -4,31 +4,34 @@
 # Reformats a QuadBase2-outputted BED file into a easier-parsable GFF file
 # =============================================================================
 
-def reformatBED(bedPath, fastaPath):
+import Instrument
+
+@Instrument.timed('reformatBED')
+def reformatBED(bedPath, fastaPath, seqidIndex=None):
 	"""Reformat a QuadBase2-outputted BED file to a more-parsable GFF file.
 	
 	:param bedPath: path to the BED-formatted QuadBase2 file
 	:param fastaPath: path to the FASTA-formatted genomic sequence file
+	:param seqidIndex: position of the sequence label within each FASTA header (default=asks the user)
 	:return: writes a GFF-formatted QuadBase2 file to the same directory as bedPath
 	"""
-	from operator import itemgetter
-	from natsort import natsorted
-	from Utils import generateSeqRegs
+	from Utils import generateSeqRegs, openFile, derivePath, SeqidOrder
 	print('\nReformatting BED to GFF...')
 	
 	# Prepares new GFF file
-	bedToGFFPath = bedPath[:-3] + 'gff3'
-	bedToGFF = open(bedToGFFPath, 'w')
+	bedToGFFPath = derivePath(bedPath, 'gff3')
+	bedToGFF = openFile(bedToGFFPath, 'w')
 	bedToGFF.write('##gff-version 3\n')
 	
 	# Extracts sequence-regions from GFF file and writes to file
-	for line in generateSeqRegs(fastaPath): bedToGFF.write(line + '\n')
+	seqregs = generateSeqRegs(fastaPath, seqidIndex)
+	for line in seqregs: bedToGFF.write(line + '\n')
 	
 	# Loads BED file into memory and sorts entries by sequence id and start position
 	bed = []
-	with open(bedPath) as bedFile:
+	with openFile(bedPath) as bedFile:
 		for line in bedFile: bed.append(line.split('\t'))
-	bed = natsorted(bed, key=itemgetter(0,1))
+	SeqidOrder.fromSeqRegs(seqregs).sort(bed, key=lambda line: (line[0], int(line[1])))
 	
 	# For determining the strand of a gplex
 	def detStrand():
@@ -38,29 +41,33 @@ def reformatBED(bedPath, fastaPath):
 	
 	# Iterate over all G-plex entries in 'bed'
 	for i, line in enumerate(bed):
-		seqid = line[0]			# column 1: seqid
-		source = 'QuadBase2'	# column 2: source
-		typ = 'G_quartet'		# column 3: type
-		start = int(line[1])+1	# column 4: start (converts from 0 to 1-indexing)
-		end = int(line[2])		# column 5: end (end index stays the same)
-		score = line[3]			# column 6: score
-		strand = detStrand()	# column 7: strand
-		phase = '.'				# column 8: phase
-		ID = i					# column 9: attributes
-		nm = i
-		motif = line[4]
-		sequence = line[5].strip()
-		
-		# Write everything
-		bedToGFF.write(seqid + '\t' + source + '\t' + typ + '\t' + str(start) + '\t' + str(
-			end) + '\t' + score + '\t' + strand + '\t' + phase + '\tID=gplex_' + str(
-			ID) + ';Name=gplex_' + str(
-			nm) + ';motif=' + motif + ';sequence=' + sequence + ';start=' + str(
-			start) + ';end=' + str(end) + '\n')
+		start = int(line[1])+1	# converts from 0 to 1-indexing (end index stays the same)
+		bedToGFF.write(gplexEntry(i, line[0], 'QuadBase2', start, int(line[2]), line[3], detStrand(), line[4], line[5].strip()))
 	
 	bedToGFF.close()
+	Instrument.count(len(bed))
 	print('Finished writing output to ' + bedToGFFPath + '\nFinished reformatting!\n')
 	
+def gplexEntry(i, seqid, source, start, end, score, strand, motif, sequence):
+	"""Format a gplex as a line of a GFF3 file.
+	
+	:param i: number of the gplex, used for its ID and name
+	:param seqid: the sequence that the gplex lies on
+	:param source: the program that found the gplex
+	:param start: start position of the gplex (1-based, inclusive)
+	:param end: end position of the gplex (1-based, inclusive)
+	:param score: score of the gplex
+	:param strand: strand of the gplex ('+', '-' or '?')
+	:param motif: the motif that the gplex matches
+	:param sequence: the sequence of the gplex
+	:return: a GFF3 line, including the line break
+	"""
+	typ = 'G_quartet'		# column 3: type
+	phase = '.'				# column 8: phase
+	return (seqid + '\t' + source + '\t' + typ + '\t' + str(start) + '\t' + str(end) + '\t' + str(score) + '\t' + strand + '\t' + phase
+		+ '\tID=gplex_' + str(i) + ';Name=gplex_' + str(i) + ';motif=' + motif + ';sequence=' + sequence
+		+ ';start=' + str(start) + ';end=' + str(end) + '\n')
+	
 # =============================================================================
 
 if __name__ == '__main__':
@@ -73,6 +80,8 @@ if __name__ == '__main__':
 						help='path to the FASTA-formatted genomic sequence file')
 	parser.add_argument('bedToGFFPath',
 						help='path where the reformatted file should be written to')
+	parser.add_argument('--seqidIndex', type=int, action='store', default=None,
+						help='position of the sequence label within each FASTA header (default=asks the user)')
 	args = parser.parse_args()
 	
-	reformatBED(args.bedPath, args.fastaPath)
\ No newline at end of file
+	reformatBED(args.bedPath, args.fastaPath, args.seqidIndex)
\ No newline at end of file
@@ -0,0 +1,238 @@
+# =============================================================================
+# bmle
+# G4Pipeline: Benchmark.py
+# Times every pipeline stage on synthetic inputs of increasing size, to catch
+# performance regressions
+# =============================================================================
+
+# Stages that are timed, in the order they are run
+STAGES = ['load', 'reformatBED', 'G4Finder', 'NonAlignments', 'GeneOverlap', 'NearestAnnot.generate', 'NearestAnnot.summarize', 'NearestAnnot.render',
+	'Splitter']
+
+G4_MOTIFS = ['GGGTTAGGGTTAGGGTTAGGG', 'GGGAGGGCGGGAGGG', 'GGGGTGGGGTGGGGTGGGG']
+
+def generate(outDir, contigs=8, contigLength=200000, genesPerContig=40, hitsPerMb=5000, gplexesPerMb=500, seed=1):
+	"""Generate a synthetic genome and the pipeline's inputs for it.
+
+	The same arguments always generate the same files.
+
+	:param outDir: directory where the files should be written
+	:param contigs: number of sequences in the genome (default=8)
+	:param contigLength: length of each sequence; at least 1000 (default=200000)
+	:param genesPerContig: number of genes annotated on each sequence (default=40)
+	:param hitsPerMb: number of blastn alignments per Mb of sequence (default=5000)
+	:param gplexesPerMb: number of G-quadruplexes per Mb of sequence (default=500)
+	:param seed: seed of the random number generator (default=1)
+	:return: a dict of paths to the 'fasta', 'annot', 'bed' and 'sam' files
+	"""
+	import os
+	import random
+
+	if contigLength < 1000: raise ValueError('Sequences must be at least 1000 bp long!')
+	rng = random.Random(seed)
+	os.makedirs(outDir, exist_ok=True)
+	paths = {'fasta': os.path.join(outDir, 'genome.fa'), 'annot': os.path.join(outDir, 'annot.gff3'),
+		'bed': os.path.join(outDir, 'quadbase2.bed'), 'sam': os.path.join(outDir, 'blastn.sam')}
+	names = ['ctg' + str(i) for i in range(1, contigs+1)]
+
+	# Genome, with G-quadruplex motifs on both strands; their positions make up the BED file
+	with open(paths['fasta'], 'w') as fasta, open(paths['bed'], 'w') as bed:
+		for name in names:
+			slots = range(0, contigLength - 40, 40)
+			count = min(len(slots), max(1, round(gplexesPerMb * contigLength / 1000000)))
+			starts = sorted(rng.sample(slots, count))
+			pieces = []
+			prevEnd = 0
+			for start in starts:
+				motif = rng.choice(G4_MOTIFS)
+				if rng.random() < 0.5: motif = motif[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+				pieces.append(''.join(rng.choices('ACGT', k=start-prevEnd)))
+				pieces.append(motif)
+				prevEnd = start + len(motif)
+				bed.write(name + '\t' + str(start) + '\t' + str(prevEnd) + '\t' + str(rng.randint(1, 9)) + '\tG3L1-7\t' + motif + '\n')
+			pieces.append(''.join(rng.choices('ACGT', k=contigLength-prevEnd)))
+			seq = ''.join(pieces)
+			fasta.write('>' + name + ' synthetic contig\n')
+			for i in range(0, contigLength, 60): fasta.write(seq[i:i+60] + '\n')
+
+	# Annotations, with a gene, mRNA, exon and CDS per gene; genes span up to 5000 bp (or half a sequence)
+	geneLength = min(5000, contigLength // 2)
+	with open(paths['annot'], 'w') as annot:
+		annot.write('##gff-version 3\n')
+		for name in names: annot.write('##sequence-region ' + name + ' 1 ' + str(contigLength) + '\n')
+		n = 0
+		for name in names:
+			for _ in range(genesPerContig):
+				n += 1
+				start = rng.randint(1, contigLength - geneLength)
+				end = start + rng.randint(300, geneLength)
+				strand = rng.choice('+-')
+				for typ, s, e, attributes in (('gene', start, end, 'ID=gene' + str(n) + ';Name=g' + str(n)),
+						('mRNA', start, end, 'ID=mrna' + str(n) + ';Parent=gene' + str(n)),
+						('exon', start, end, 'ID=exon' + str(n) + ';Parent=mrna' + str(n)),
+						('CDS', start+50, end-50, 'ID=cds' + str(n) + ';Parent=mrna' + str(n))):
+					annot.write(name + '\tsynthetic\t' + typ + '\t' + str(s) + '\t' + str(e) + '\t.\t' + strand + '\t.\t' + attributes + '\n')
+
+	# blastn alignments against the genome, with blastn's 'Query_#' sequence names; alignments span up to 805 bp (or half a sequence)
+	margin = min(1000, contigLength // 2)
+	with open(paths['sam'], 'w') as sam:
+		sam.write('@HD\tVN:1.0\tSO:unsorted\n')
+		for i in range(len(names)): sam.write('@SQ\tSN:Query_' + str(i+1) + '\tLN:' + str(contigLength) + '\n')
+		for i in range(len(names)):
+			for _ in range(max(1, round(hitsPerMb * contigLength / 1000000))):
+				start = rng.randint(1, contigLength - margin)
+				half = rng.randint(10, min(400, margin // 2 - 5))
+				sam.write('Subject_' + str(rng.randint(1, 9)) + '\t0\tQuery_' + str(i+1) + '\t' + str(start) + '\t255\t'
+					+ str(half) + 'M' + str(rng.randint(1, 5)) + 'D' + str(half) + 'M\t*\t0\t0\t*\t*\tAS:i:' + str(2*half) + '\n')
+	return paths
+
+def run(outDir, scales=(1, 2, 4), repeats=3, workers=1, **kwargs):
+	"""Time every stage on synthetic inputs of each scale.
+
+	Each scale multiplies the length of every sequence and the number of genes on it,
+	so the density of features stays the same while the amount of work per sequence grows.
+
+	:param outDir: directory where the synthetic inputs and outputs should be written
+	:param scales: factors applied to the size of the inputs (default=(1, 2, 4))
+	:param repeats: number of times each stage is run; the fastest run is kept (default=3)
+	:param workers: number of processes that sequences are shared out to; 0 uses every CPU (default=1)
+	:param kwargs: any arguments to generate() for the smallest scale
+	:return: a dict mapping each stage to a dict of 'seconds' (one per scale), 'throughput' (MB/s of its main input per scale) and 'exponent'
+	"""
+	import os
+	import sys
+	import time
+	import contextlib
+	import Cache
+	import Utils
+	import BedToGFF
+	import G4Finder
+	import NonAlignments
+	import GeneOverlap
+	import NearestAnnot
+	import Splitter
+
+	Cache.configure(enabled=False)	# times the actual parsing
+	contigLength = kwargs.pop('contigLength', 200000)
+	genesPerContig = kwargs.pop('genesPerContig', 40)
+	results = {stage: {'seconds': [], 'throughput': []} for stage in STAGES}
+	sizes = []
+
+	for scale in scales:
+		print('Generating inputs at scale ' + str(scale) + '...')
+		scaleDir = os.path.join(outDir, 'scale_' + str(scale))	# separate paths, as parsed files are memoized by path
+		paths = generate(scaleDir, contigLength=contigLength*scale, genesPerContig=genesPerContig*scale, **kwargs)
+		gplex = Utils.derivePath(paths['bed'], 'gff3')
+		nal = Utils.derivePath(paths['sam'], 'gff3')
+		dataPath = os.path.join(scaleDir, 'analyses', 'gplex.tsv')
+		splitSize = 2 * os.path.getsize(paths['fasta']) / len(Utils.loadFastaIndex(paths['fasta'])) / 1000000
+		sizes.append(sum(os.path.getsize(path) for path in paths.values()))
+
+		# GeneOverlap and NearestAnnot.generate run non-incrementally, so that repeats time a full
+		# recalculation rather than reusing the partials of the run before
+		calls = {'load': (Utils.load, paths['annot']),
+			'reformatBED': (BedToGFF.reformatBED, paths['bed'], paths['fasta'], 1),
+			'G4Finder': (G4Finder.main, paths['fasta'], os.path.join(scaleDir, 'genome.g4.gff3'), 3, 7, 1, 7, workers, 1),
+			'NonAlignments': (NonAlignments.main, paths['sam'], workers, paths['fasta'], 1),
+			'GeneOverlap': (GeneOverlap.main, paths['annot'], gplex, nal, 0.2, 100, workers, False),
+			'NearestAnnot.generate': (NearestAnnot.generate, gplex, paths['annot'], dataPath, workers, False),
+			'NearestAnnot.summarize': (NearestAnnot.summarize, dataPath, paths['fasta'], 1),
+			'NearestAnnot.render': (NearestAnnot.render, dataPath),
+			'Splitter': (Splitter.main, paths['fasta'], splitSize)}
+		for stage in STAGES:
+			func, *args = calls[stage]
+			inputSize = os.path.getsize(args[0])		# the main input of every stage comes first
+			best = None
+			try:
+				for _ in range(repeats):
+					with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+						start = time.perf_counter()
+						func(*args)
+						seconds = time.perf_counter() - start
+					if best is None or seconds < best: best = seconds
+			except ImportError as e:
+				print('\tSkipping ' + stage + ' (' + str(e) + ')', file=sys.stderr)
+			results[stage]['seconds'].append(best)
+			results[stage]['throughput'].append(round(inputSize / best / 1000000, 2) if best else None)
+
+	for stage in STAGES: results[stage]['exponent'] = scalingExponent(sizes, results[stage]['seconds'])
+	return results
+
+def scalingExponent(sizes, seconds):
+	"""Estimate how run time grows with input size, as the slope of a least-squares fit on a log-log scale.
+
+	An exponent around 1 is linear; around 2 is quadratic.
+
+	:param sizes: input sizes
+	:param seconds: run times at each input size; None for runs that were skipped
+	:return: the fitted exponent, or None if there are fewer than two timed runs
+	"""
+	import math
+
+	points = [(math.log(x), math.log(y)) for x, y in zip(sizes, seconds) if y]
+	if len(points) < 2: return None
+	meanX = sum(x for x, _ in points) / len(points)
+	meanY = sum(y for _, y in points) / len(points)
+	varX = sum((x-meanX)**2 for x, _ in points)
+	if varX == 0: return None
+	return round(sum((x-meanX)*(y-meanY) for x, y in points) / varX, 2)
+
+def writer(results, scales):
+	"""Print a table of benchmark results.
+
+	:param results: results generated by run()
+	:param scales: the scales that were run
+	:return: nothing
+	"""
+	rows = [['stage'] + ['x' + str(scale) + ' (s)' for scale in scales] + ['x' + str(scales[-1]) + ' (MB/s)', 'exponent']]
+	for stage, result in results.items():
+		rows.append([stage] + ['-' if s is None else str(round(s, 3)) for s in result['seconds']]
+			+ [str(result['throughput'][-1] or '-'), str(result['exponent'] or '-')])
+	width = [max(len(x) + 2 for x in col) for col in zip(*rows)]
+	for row in rows: print(''.join(x.ljust(width[i]) for i, x in enumerate(row)).rstrip())
+
+# =============================================================================
+
+if __name__ == '__main__':
+	import sys
+	import json
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Time every pipeline stage on synthetic inputs of increasing size.')
+	parser.add_argument('outDir',
+						help='directory where the synthetic inputs and outputs should be written')
+	parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 4],
+						help='factors applied to the size of the inputs (default=1 2 4)')
+	parser.add_argument('--contigs', type=int, default=8,
+						help='number of sequences in the genome (default=8)')
+	parser.add_argument('--contigLength', type=int, default=200000,
+						help='length of each sequence at scale 1; at least 1000 (default=200000)')
+	parser.add_argument('--genesPerContig', type=int, default=40,
+						help='number of genes on each sequence at scale 1 (default=40)')
+	parser.add_argument('--hitsPerMb', type=int, default=5000,
+						help='number of blastn alignments per Mb of sequence (default=5000)')
+	parser.add_argument('--gplexesPerMb', type=int, default=500,
+						help='number of G-quadruplexes per Mb of sequence (default=500)')
+	parser.add_argument('--seed', type=int, default=1,
+						help='seed of the random number generator (default=1)')
+	parser.add_argument('--repeats', type=int, default=3,
+						help='number of times each stage is run; the fastest run is kept (default=3)')
+	parser.add_argument('--workers', type=int, default=1,
+						help='number of processes that sequences are shared out to; 0 uses every CPU (default=1)')
+	parser.add_argument('--maxExponent', type=float, default=1.5,
+						help='exit with an error if any stage scales worse than this (default=1.5)')
+	parser.add_argument('--report',
+						help='path where the results should be written as JSON')
+	args = parser.parse_args()
+	if args.contigLength < 1000: parser.error('--contigLength must be at least 1000')
+
+	results = run(args.outDir, args.scales, args.repeats, args.workers, contigs=args.contigs, contigLength=args.contigLength,
+		genesPerContig=args.genesPerContig, hitsPerMb=args.hitsPerMb, gplexesPerMb=args.gplexesPerMb, seed=args.seed)
+	writer(results, args.scales)
+	if args.report:
+		with open(args.report, 'w') as f: json.dump({'scales': args.scales, 'stages': results}, f, indent='\t')
+
+	slow = [stage for stage, result in results.items() if result['exponent'] is not None and result['exponent'] > args.maxExponent]
+	if slow:
+		print('Stages scaling worse than n^' + str(args.maxExponent) + ': ' + ', '.join(slow), file=sys.stderr)
+		sys.exit(1)
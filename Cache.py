@@ -0,0 +1,112 @@
+# =============================================================================
+# bmle
+# G4Pipeline: Cache.py
+# On-disk cache of parsed input files, so unchanged inputs aren't re-parsed
+# =============================================================================
+
+import os
+
+# Bump whenever the layout of any cached object changes
+VERSION = 3
+
+settings = {
+	'enabled': os.environ.get('G4_CACHE', '1') != '0',
+	'directory': os.environ.get('G4_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'G4Pipeline')),
+	'maxSize': float(os.environ.get('G4_CACHE_SIZE', 2048)),	# in MB
+	'hashContent': os.environ.get('G4_CACHE_HASH', '0') == '1',
+}
+
+def configure(enabled=None, directory=None, maxSize=None, hashContent=None):
+	"""Change the cache settings for the current process.
+
+	:param enabled: whether parsed files should be cached at all
+	:param directory: directory where cached files are stored
+	:param maxSize: max total size (in MB) of the cache directory
+	:param hashContent: whether to also key cached files by a hash of the input's contents
+	:return: nothing
+	"""
+	for key, value in (('enabled', enabled), ('directory', directory), ('maxSize', maxSize), ('hashContent', hashContent)):
+		if value is not None: settings[key] = value
+
+def cached(builder, filePath, *args):
+	"""Call builder(filePath, *args), reusing a previously cached result if filePath hasn't changed.
+
+	Results are pickled into the cache directory under a key made from the builder,
+	its arguments, and the path, size and modification time of filePath (plus a hash
+	of its contents if enabled). Reading a cached result unpickles it in full, which
+	is still much faster than re-parsing the text file.
+
+	:param builder: the function that parses filePath
+	:param filePath: path to the input file
+	:param args: any additional arguments to builder
+	:return: the result of builder(filePath, *args)
+	"""
+	import pickle
+
+	if not settings['enabled']: return builder(filePath, *args)
+	cachePath = os.path.join(settings['directory'], _key(builder, filePath, args) + '.pkl')
+
+	# Reads the cached result if it exists
+	try:
+		with open(cachePath, 'rb') as f: result = pickle.load(f)
+		os.utime(cachePath)		# marks as recently used
+		return result
+	except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+		pass
+
+	# Otherwise builds and stores it
+	result = builder(filePath, *args)
+	try:
+		os.makedirs(settings['directory'], exist_ok=True)
+		tempPath = cachePath + '.' + str(os.getpid()) + '.tmp'
+		with open(tempPath, 'wb') as f: pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tempPath, cachePath)
+		evict()
+	except OSError:
+		pass	# caching is best-effort
+	return result
+
+def evict(maxSize=None):
+	"""Remove the least recently used cached files until the cache fits in maxSize.
+
+	:param maxSize: max total size (in MB) of the cache directory (default=settings['maxSize'])
+	:return: nothing
+	"""
+	maxBytes = (settings['maxSize'] if maxSize is None else maxSize) * 1000000
+	entries = []
+	with os.scandir(settings['directory']) as it:
+		for entry in it:
+			if entry.name.endswith('.pkl'):
+				stat = entry.stat()
+				entries.append((stat.st_mtime, stat.st_size, entry.path))
+	total = sum(size for _, size, _ in entries)
+	for _, size, path in sorted(entries):
+		if total <= maxBytes: break
+		try: os.remove(path)
+		except OSError: pass
+		total -= size
+
+def clear():
+	"""Remove every cached file.
+
+	:return: nothing
+	"""
+	evict(0)
+
+def _key(builder, filePath, args):
+	"""Build the cache key for a call to builder.
+
+	:param builder: the function that parses filePath
+	:param filePath: path to the input file
+	:param args: any additional arguments to builder
+	:return: a hex digest identifying the call and the state of filePath
+	"""
+	import hashlib
+
+	stat = os.stat(filePath)
+	h = hashlib.sha1(repr((VERSION, builder.__module__, builder.__qualname__, os.path.abspath(filePath),
+		stat.st_size, stat.st_mtime_ns, args)).encode())
+	if settings['hashContent']:
+		with open(filePath, 'rb') as f:
+			for block in iter(lambda: f.read(1 << 20), b''): h.update(block)
+	return h.hexdigest()
@@ -0,0 +1,173 @@
+# =============================================================================
+# bmle
+# G4Pipeline: G4Finder.py
+# Finds G-quadruplex motifs in a FASTA file, writing the same GFF3 file that
+# BedToGFF.py generates from a QuadBase2 BED file
+# =============================================================================
+
+import Instrument
+
+@Instrument.timed('G4Finder')
+def main(fastaPath, outPath=None, minRun=3, maxRun=7, minLoop=1, maxLoop=7, workers=1, seqidIndex=None):
+	"""Generate a GFF3 file of G-quadruplex motifs on both strands of every sequence.
+
+	A motif is four G-runs separated by three loops (or four C-runs, for the antisense
+	strand); overlapping motifs aren't reported.
+
+	:param fastaPath: path to the FASTA-formatted genomic sequence file
+	:param outPath: path where the GFF3 file should be written (default=next to fastaPath, ending in '.g4.gff3')
+	:param minRun: min length of each G-run (default=3)
+	:param maxRun: max length of each G-run (default=7)
+	:param minLoop: min length of each loop (default=1)
+	:param maxLoop: max length of each loop (default=7)
+	:param workers: number of processes that sequences are shared out to; 0 uses every CPU (default=1)
+	:param seqidIndex: position of the sequence label within each FASTA header (default=asks the user)
+	:return: writes a GFF3 file of gplexes
+	"""
+	from BedToGFF import gplexEntry
+	from Utils import loadFastaIndex, seqLabels, generateSeqRegs, isCompressed, mapShards, openFile, derivePath, SeqidOrder
+	print('\nFinding G-quadruplexes...')
+
+	if outPath is None: outPath = derivePath(fastaPath, 'g4.gff3')
+	params = (minRun, maxRun, minLoop, maxLoop)
+	motif = 'G' + str(minRun) + 'L' + str(minLoop) + '-' + str(maxLoop)
+	labels = seqLabels(fastaPath, seqidIndex)
+
+	# Each worker maps its own sequences from the file; compressed files can only be read in order
+	print('Scanning sequences...')
+	if isCompressed(fastaPath):
+		shards = ((label, sequence, params) for label, sequence in zip(labels, _readSequences(fastaPath)))
+		results = (findMotifs(shard) for shard in shards)
+	else:
+		shards = [(label, (fastaPath, entry[2], entry[1]), params) for label, entry in zip(labels, loadFastaIndex(fastaPath))]
+		results = mapShards(findMotifs, shards, workers)
+	found = dict(zip(labels, Instrument.progress(results, 'Sequences', total=len(labels))))
+
+	# Writes to GFF file, in the same order as BedToGFF.reformatBED()
+	print('Writing to file...')
+	i = 0
+	with openFile(outPath, 'w') as outFile:
+		outFile.write('##gff-version 3\n')
+		for line in generateSeqRegs(fastaPath, seqidIndex): outFile.write(line + '\n')
+		for label in SeqidOrder(found).sort(list(found), key=lambda label: (label,)):
+			for start, end, score, strand, sequence in found[label]:
+				outFile.write(gplexEntry(i, label, 'G4Finder', start+1, end, score, strand, motif, sequence))
+				i += 1
+	Instrument.count(i)
+
+	print('Finished writing ' + str(i) + ' G-quadruplexes to ' + outPath + '\nFinished!\n')
+
+def findMotifs(shard):
+	"""Find the G-quadruplex motifs of a single sequence.
+
+	The sequence is read in blocks; a motif is only accepted once the block extends
+	far enough past its start to hold the longest possible motif, so the result is
+	the same as when scanning the whole sequence at once.
+
+	:param shard: a tuple of (seqid, sequence, (minRun, maxRun, minLoop, maxLoop)), where the sequence
+		is either bytes or a tuple of (path to FASTA file, byte offset, length) to read it from
+	:return: a list of (start, end, score, strand, sequence) tuples (0-based, half-open coordinates), sorted by position;
+		the score is the number of stacked G-quartets
+	"""
+	import re
+
+	seqid, source, (minRun, maxRun, minLoop, maxLoop) = shard
+	loop = b'.{%d,%d}?' % (minLoop, maxLoop)
+	patterns = []
+	for base, strand in ((b'G', '+'), (b'C', '-')):
+		run = b'(' + base + b'{%d,%d})' % (minRun, maxRun)
+		patterns.append((re.compile(loop.join([run] * 4), re.IGNORECASE | re.DOTALL), strand))
+	margin = 4*maxRun + 3*maxLoop		# longest possible motif
+
+	hits = []
+	buffer = b''
+	bufferStart = 0						# position of buffer[0] in the sequence
+	searchFrom = [0 for _ in patterns]	# where each pattern resumes, relative to buffer
+	blocks = iter(_readBlocks(*source) if isinstance(source, tuple) else [source])
+	block = next(blocks, b'')
+	while True:
+		nextBlock = next(blocks, None)
+		buffer += block
+		final = nextBlock is None
+		limit = len(buffer) if final else len(buffer) - margin
+		for p, (pattern, strand) in enumerate(patterns):
+			for m in pattern.finditer(buffer, searchFrom[p]):
+				if m.start() >= limit: break
+				score = min(len(m.group(g)) for g in (1, 2, 3, 4))
+				hits.append((bufferStart + m.start(), bufferStart + m.end(), score, strand, m.group().decode()))
+				searchFrom[p] = m.end()
+			searchFrom[p] = max(searchFrom[p], limit)
+		if final: break
+
+		# Drops the part of the buffer that every pattern has moved past
+		drop = min(searchFrom)
+		buffer = buffer[drop:]
+		bufferStart += drop
+		searchFrom = [pos - drop for pos in searchFrom]
+		block = nextBlock
+	hits.sort()
+	return hits
+
+def _readBlocks(fastaPath, offset, length, blockSize=1 << 22):
+	"""Read the residues of a sequence from a FASTA file in blocks, through a memory map.
+
+	:param fastaPath: path to the uncompressed FASTA file
+	:param offset: byte offset of the first residue, as in the FASTA index
+	:param length: number of residues
+	:param blockSize: number of bytes read at a time (default=4 MB)
+	:return: a generator of blocks of residues (bytes), without line breaks
+	"""
+	import mmap
+
+	with open(fastaPath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+		pos = offset
+		remaining = length
+		while remaining > 0 and pos < len(mm):
+			block = mm[pos:pos+blockSize].translate(None, b'\r\n')[:remaining]
+			pos += blockSize
+			remaining -= len(block)
+			yield block
+
+def _readSequences(fastaPath):
+	"""Read every sequence of a FASTA file in order.
+
+	:param fastaPath: path to the (possibly compressed) FASTA file
+	:return: a generator of sequences (bytes)
+	"""
+	from Utils import openFile
+
+	lines = None
+	with openFile(fastaPath, 'rb') as fastaFile:
+		for line in fastaFile:
+			if line.startswith(b'>'):
+				if lines is not None: yield b''.join(lines)
+				lines = []
+			elif lines is not None:
+				lines.append(line.rstrip(b'\r\n'))
+	if lines is not None: yield b''.join(lines)
+
+# =============================================================================
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Generate a GFF3 file of G-quadruplex motifs on both strands of every sequence.')
+	parser.add_argument('fastaPath',
+						help='path to the FASTA-formatted genomic sequence file')
+	parser.add_argument('--outPath',
+						help='path where the GFF3 file should be written (default=next to fastaPath, ending in \'.g4.gff3\')')
+	parser.add_argument('--minRun', type=int, action='store', default=3,
+						help='min length of each G-run (default=3)')
+	parser.add_argument('--maxRun', type=int, action='store', default=7,
+						help='max length of each G-run (default=7)')
+	parser.add_argument('--minLoop', type=int, action='store', default=1,
+						help='min length of each loop (default=1)')
+	parser.add_argument('--maxLoop', type=int, action='store', default=7,
+						help='max length of each loop (default=7)')
+	parser.add_argument('--workers', type=int, action='store', default=1,
+						help='number of processes that sequences are shared out to; 0 uses every CPU (default=1)')
+	parser.add_argument('--seqidIndex', type=int, action='store', default=None,
+						help='position of the sequence label within each FASTA header (default=asks the user)')
+	args = parser.parse_args()
+
+	main(args.fastaPath, args.outPath, args.minRun, args.maxRun, args.minLoop, args.maxLoop, args.workers, args.seqidIndex)
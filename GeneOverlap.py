@@ -6,73 +6,307 @@
 # non-alignment at the same position.
 # =============================================================================
 
-def main(gffPath, gplexPath, nalPath, minCov=0.5, maxDist=0):
+import Instrument
+
+@Instrument.timed('GeneOverlap')
+def main(gffPath, gplexPath, nalPath, minCov=0.5, maxDist=0, workers=1, incremental=True, tracks=False):
 	"""Generate a GFF file of genes that overlap at least one gplex and at least one non-alignment.
 	
+	A gene's coverage is the fraction of its bases that lie in at least one non-alignment, so
+	non-alignments that overlap each other aren't counted twice.
+	
 	:param gffPath: path to the GFF3-formatted gene annotation file
 	:param gplexPath: path to the GFF3-formatted gplex file
 	:param nalPath: path to the GFF3-formatted non-alignment file
 	:param minCov: minimum overlap required of non-aligned region (default=0.5)
 	:param maxDist: max number of base pairs separating a gplex and gene (default=0)
+	:param workers: number of processes that sequences are shared out to; 0 uses every CPU (default=1)
+	:param incremental: if True, only recalculates sequences whose entries changed since the last run (default=True)
+	:param tracks: if True, also writes the coverage of non-alignments and gplexes to 'nals.bedGraph' and 'gplexes.bedGraph' (default=False)
 	:return: filters the three inputted files for entries that overlap each other into separate files
 	"""
 	import os
-	from Utils import load, writeFile
+	from Utils import mapShards, mapChangedShards, outputPath
 	print('\nGenerating gene overlaps...')
 	
-	print('Loading files...')
-	gplexData = load(gplexPath)[2]
-	nalsData = load(nalPath)[2]
-	tempGeneData = load(gffPath)
-	headers = tempGeneData[0] + tempGeneData[1]
-	geneData = []
-	for line in tempGeneData[2]:
-		if line[2]=='gene': geneData.append(line)
+	headers, tables, shards, offsets = _loadShards(gffPath, gplexPath, nalPath, (minCov, maxDist))
+	geneData, nalsData, gplexData = tables
 	
 	# Finds overlaps for each ORF
 	print('Calculating overlaps...')
+	output = os.path.join(os.path.dirname(gffPath) or '.', 'overlaps', '')
 	genes = []
-	nals = []
-	gplexes = []
-	
-	l = len(geneData)
-	for i, gene in enumerate(geneData):
-		print('\tCalculating ' + str(i+1) + ' of ' + str(l) + '...')
-		tempNals = []
-		tempGplexes = []
-		sumCov = 0
-		gStart = int(gene[3])
-		gEnd = int(gene[4])
-		
-		# Iterates over each non-alignment
-		for nline in nalsData:
-			if nline[0] == gene[0]:
-				start = max(gStart, int(nline[3]))
-				end = min(gEnd, int(nline[4]))
-				if end > start:
-					tempNals.append(nline)
-					sumCov += (end-start)
-		
-		# Iterates over each gplex; gplex is included if its distance to the orf doesn't exceed 'maxDist'
-		for gplex in gplexData:
-			if gplex[0] == gene[0]:
-				start = max(gStart, int(gplex[3]))
-				end = min(gEnd, int(gplex[4]))
-				if (start-end) <= int(maxDist):	tempGplexes.append(gplex)
-
-		# If coverage is at least 'minCov' and there exists at least one gplex, add to data
-		if (sumCov/(gEnd-gStart) > float(minCov)) and (len(tempGplexes) > 0):
-			genes.append(gene)
-			nals.extend(tempNals)
-			gplexes.extend(tempGplexes)
+	nals = set()
+	gplexes = set()
+	if incremental:
+		os.makedirs(output, exist_ok=True)
+		prints = [table.fingerprints() for table in tables]
+		fingerprints = [tuple(table.get(shard[0]) for table in prints) + (float(minCov), int(maxDist)) for shard in shards]
+		results = mapChangedShards(findOverlaps, shards, fingerprints, output + '.partials.pkl', workers)
+	else:
+		results = mapShards(findOverlaps, shards, workers)
+	results = Instrument.progress(results, 'Sequences', total=len(shards))
+	for (lo, nlo, glo), result in zip(offsets, results):
+		genes.extend(lo+i for i in result[0])
+		nals.update(nlo+i for i in result[1])
+		gplexes.update(glo+i for i in result[2])
 			
 	# Write everything
 	print('Writing to output files...')
-	output = os.path.dirname(gffPath) + '/overlaps/'
-	writeFile(output + 'genes.gff', headers, genes)
-	writeFile(output + 'nals.gff', headers, nals)
-	writeFile(output + 'gplexes.gff', headers, gplexes)
+	_writeOverlaps(output, headers, tables, genes, nals, gplexes)
+	if tracks:
+		for name, table in (('nals', nalsData), ('gplexes', gplexData)): writeTrack(outputPath(output + name + '.bedGraph'), table, name)
+	Instrument.count(len(geneData))
+	print('Finished writing output to ' + output + '\nFinished!')
+
+@Instrument.timed('GeneOverlap-sweep')
+def sweep(gffPath, gplexPath, nalPath, minCovs, maxDists, cells=(), workers=1):
+	"""Count the genes that pass every combination of a grid of thresholds, scanning the files once.
+	
+	The coverage of each gene by non-alignments and its distance to the closest gplex are only
+	calculated once, so the whole grid costs about as much as a single call to main(). The
+	counts are written to 'overlaps/sweep.tsv', with a row for each minCov and a column for each
+	maxDist; the same files as main() are written for each of cells, to 'overlaps/sweep/'.
+	
+	:param gffPath: path to the GFF3-formatted gene annotation file
+	:param gplexPath: path to the GFF3-formatted gplex file
+	:param nalPath: path to the GFF3-formatted non-alignment file
+	:param minCovs: the minimum overlaps required of non-aligned regions to try
+	:param maxDists: the max numbers of base pairs separating a gplex and gene to try; must not be negative
+	:param cells: the (minCov, maxDist) pairs to write the filtered files of (default=none)
+	:param workers: number of processes that sequences are shared out to; 0 uses every CPU (default=1)
+	:return: a dict mapping each (minCov, maxDist) pair of the grid to its number of genes
+	"""
+	import os
+	from bisect import bisect_left
+	from Utils import mapShards
+	print('\nSweeping gene overlap thresholds...')
+	
+	minCovs = sorted(set(float(minCov) for minCov in minCovs))
+	maxDists = sorted(set(int(maxDist) for maxDist in maxDists))
+	cells = [(float(minCov), int(maxDist)) for minCov, maxDist in cells]
+	if any(maxDist < 0 for maxDist in maxDists + [cell[1] for cell in cells]): raise ValueError('The distances of a sweep must not be negative!')
+	headers, tables, shards, offsets = _loadShards(gffPath, gplexPath, nalPath, (cells,))
+	
+	# Calculates the coverage and gplex distance of each gene, and filters the files of each cell
+	print('Calculating coverage and distances...')
+	coverages = []
+	distances = []
+	selected = [([], set(), set()) for _ in cells]
+	results = Instrument.progress(mapShards(sweepOverlaps, shards, workers), 'Sequences', total=len(shards))
+	for (lo, nlo, glo), result in zip(offsets, results):
+		coverages.extend(result[0])
+		distances.extend(result[1])
+		for (genes, nals, gplexes), cell in zip(selected, result[2]):
+			genes.extend(lo+i for i in cell[0])
+			nals.update(nlo+i for i in cell[1])
+			gplexes.update(glo+i for i in cell[2])
+	
+	# A gene passes the minCovs below its bucket, and every maxDist from its distance on; maxDists are
+	# visited in increasing order, so each gene is added to the buckets once
+	print('Counting genes...')
+	counts = {}
+	buckets = [0] * (len(minCovs)+1)
+	order = sorted(range(len(distances)), key=distances.__getitem__)
+	k = 0
+	for maxDist in maxDists:
+		while k < len(order) and distances[order[k]] <= maxDist:
+			buckets[bisect_left(minCovs, coverages[order[k]])] += 1
+			k += 1
+		passing = 0
+		for j in range(len(minCovs)-1, -1, -1):
+			passing += buckets[j+1]
+			counts[(minCovs[j], maxDist)] = passing
+	
+	# Write everything
+	print('Writing to output files...')
+	output = os.path.join(os.path.dirname(gffPath) or '.', 'overlaps', '')
+	os.makedirs(output, exist_ok=True)
+	with open(output + 'sweep.tsv', 'w') as outFile:
+		outFile.write('\t'.join(['minCov\\maxDist'] + [str(maxDist) for maxDist in maxDists]) + '\n')
+		for minCov in minCovs:
+			outFile.write('\t'.join([str(minCov)] + [str(counts[(minCov, maxDist)]) for maxDist in maxDists]) + '\n')
+	for (minCov, maxDist), (genes, nals, gplexes) in zip(cells, selected):
+		cellOutput = output + 'sweep/minCov' + str(minCov) + '_maxDist' + str(maxDist) + '/'
+		os.makedirs(cellOutput, exist_ok=True)
+		_writeOverlaps(cellOutput, headers, tables, genes, nals, gplexes)
+		print('\t' + str(len(genes)) + ' genes with minCov ' + str(minCov) + ' and maxDist ' + str(maxDist))
+	Instrument.count(len(coverages))
 	print('Finished writing output to ' + output + '\nFinished!')
+	return counts
+
+def _loadShards(gffPath, gplexPath, nalPath, params):
+	"""Load the three files and split them into one shard per sequence.
+	
+	:param gffPath: path to the GFF3-formatted gene annotation file
+	:param gplexPath: path to the GFF3-formatted gplex file
+	:param nalPath: path to the GFF3-formatted non-alignment file
+	:param params: a tuple of parameters appended to every shard
+	:return: a tuple of (headers of gffPath, (GFFTable of genes, GFFTable of non-alignments, GFFTable of gplexes),
+		list of shards, list of the (gene, non-alignment, gplex) index of the first entry of each shard)
+	"""
+	from Utils import loadTable
+	
+	print('Loading files...')
+	gplexData = loadTable(gplexPath)[2]
+	nalsData = loadTable(nalPath)[2]
+	tempGeneData = loadTable(gffPath, types=('gene',))
+	headers = tempGeneData[0] + tempGeneData[1]
+	geneData = tempGeneData[2]
+	
+	nalRanges = {seqid: (lo, hi) for seqid, lo, hi in nalsData.ranges()}
+	gplexRanges = {seqid: (lo, hi) for seqid, lo, hi in gplexData.ranges()}
+	shards = []
+	offsets = []
+	for seqid, lo, hi in geneData.ranges():
+		nlo, nhi = nalRanges.get(seqid, (0, 0))
+		glo, ghi = gplexRanges.get(seqid, (0, 0))
+		shards.append((seqid, geneData.take(range(lo, hi)), nalsData.take(range(nlo, nhi)), gplexData.take(range(glo, ghi))) + params)
+		offsets.append((lo, nlo, glo))
+	return headers, (geneData, nalsData, gplexData), shards, offsets
+
+def _writeOverlaps(output, headers, tables, genes, nals, gplexes):
+	"""Write the filtered genes, non-alignments and gplexes to 'genes.gff', 'nals.gff' and 'gplexes.gff'.
+	
+	:param output: path to the directory where the files should be written
+	:param headers: headers of the gene annotation file
+	:param tables: a tuple of (GFFTable of genes, GFFTable of non-alignments, GFFTable of gplexes)
+	:param genes: indices of the genes to write
+	:param nals: indices of the non-alignments to write
+	:param gplexes: indices of the gplexes to write
+	:return: nothing
+	"""
+	from Utils import writeFile, outputPath
+	
+	geneData, nalsData, gplexData = tables
+	writeFile(outputPath(output + 'genes.gff'), headers, geneData.take(genes))
+	writeFile(outputPath(output + 'nals.gff'), headers, nalsData.take(sorted(nals)))
+	writeFile(outputPath(output + 'gplexes.gff'), headers, gplexData.take(sorted(gplexes)))
+
+def findOverlaps(shard):
+	"""Find the genes of a single sequence that overlap at least one gplex and at least one non-alignment.
+	
+	:param shard: a tuple of (seqid, GFFTable of annotations, GFFTable of non-alignments, GFFTable of gplexes, minCov, maxDist),
+		where every table only holds entries of that sequence
+	:return: a tuple of (list of gene indices, set of non-alignment indices, set of gplex indices) into the shard's tables
+	"""
+	from Intervals import buildIndex, buildCoverage, overlapping
+	
+	seqid, geneData, nalsData, gplexData, minCov, maxDist = shard
+	
+	# Indexes non-alignments and gplexes by position
+	nalsIndex = buildIndex(nalsData.intervals())
+	nalsCoverage = buildCoverage(nalsData.intervals())
+	gplexIndex = buildIndex(gplexData.intervals())
+	maxDist = int(maxDist)
+	
+	genes = []
+	nals = set()
+	gplexes = set()
+	for _, gStart, gEnd, gene in geneData.intervals(types=('gene',)):
+		if geneCoverage(nalsCoverage, seqid, gStart, gEnd) <= float(minCov): continue
+		tempGplexes = nearbyGplexes(gplexIndex, gplexData, seqid, gStart, gEnd, maxDist)
+
+		# If coverage is above 'minCov' and there exists at least one gplex, add to data
+		if len(tempGplexes) > 0:
+			genes.append(gene)
+			nals.update(overlapping(nalsIndex, seqid, gStart, gEnd))
+			gplexes.update(tempGplexes)
+	return genes, nals, gplexes
+
+def sweepOverlaps(shard):
+	"""Find the coverage by non-alignments and the distance to the closest gplex of each gene of a single sequence.
+	
+	:param shard: a tuple of (seqid, GFFTable of annotations, GFFTable of non-alignments, GFFTable of gplexes, list of
+		(minCov, maxDist) pairs), where every table only holds entries of that sequence
+	:return: a tuple of (list of coverages, list of distances, list of the results of findOverlaps() for each pair);
+		the distance is 0 if a gplex overlaps the gene, and infinite if the sequence has no gplexes
+	"""
+	from bisect import bisect_left, bisect_right
+	from Intervals import buildIndex, buildCoverage, overlapping
+	
+	seqid, geneData, nalsData, gplexData, cells = shard
+	nalsIndex = buildIndex(nalsData.intervals())
+	nalsCoverage = buildCoverage(nalsData.intervals())
+	gplexIndex = buildIndex(gplexData.intervals())
+	gplexStarts = sorted(gplexData.starts)
+	gplexEnds = sorted(gplexData.ends)
+	
+	coverages = []
+	distances = []
+	selected = [([], set(), set()) for _ in cells]
+	for _, gStart, gEnd, gene in geneData.intervals(types=('gene',)):
+		coverage = geneCoverage(nalsCoverage, seqid, gStart, gEnd)
+		
+		# Closest gplex that ends before the gene or starts after it, unless one overlaps it
+		distance = float('inf')
+		if overlapping(gplexIndex, seqid, gStart, gEnd):
+			distance = 0
+		else:
+			i = bisect_left(gplexEnds, gStart)
+			if i > 0: distance = gStart - gplexEnds[i-1]
+			i = bisect_right(gplexStarts, gEnd)
+			if i < len(gplexStarts): distance = min(distance, gplexStarts[i] - gEnd)
+		coverages.append(coverage)
+		distances.append(distance)
+		
+		for (minCov, maxDist), (genes, nals, gplexes) in zip(cells, selected):
+			if coverage > minCov and distance <= maxDist:
+				genes.append(gene)
+				nals.update(overlapping(nalsIndex, seqid, gStart, gEnd))
+				gplexes.update(nearbyGplexes(gplexIndex, gplexData, seqid, gStart, gEnd, maxDist))
+	return coverages, distances, selected
+
+def geneCoverage(nalsCoverage, seqid, gStart, gEnd):
+	"""Calculate how much of a gene is covered by non-alignments.
+	
+	:param nalsCoverage: coverage tracks of the non-alignments, generated by Intervals.buildCoverage()
+	:param seqid: the sequence of the gene
+	:param gStart: start position of the gene
+	:param gEnd: end position of the gene
+	:return: the fraction of the gene's bases that lie in at least one non-alignment
+	"""
+	from Intervals import coveredBases
+	return coveredBases(nalsCoverage, seqid, gStart, gEnd) / (gEnd-gStart+1)
+
+def nearbyGplexes(gplexIndex, gplexData, seqid, gStart, gEnd, maxDist):
+	"""Find the gplexes within 'maxDist' of a gene.
+	
+	:param gplexIndex: an index of the gplexes, generated by Intervals.buildIndex()
+	:param gplexData: GFFTable of gplexes
+	:param seqid: the sequence of the gene
+	:param gStart: start position of the gene
+	:param gEnd: end position of the gene
+	:param maxDist: max number of base pairs separating a gplex and the gene
+	:return: a list of gplex indices
+	"""
+	from Intervals import overlapping
+	
+	# A gplex is included if its distance to the orf doesn't exceed 'maxDist'
+	gplexes = []
+	for gplex in overlapping(gplexIndex, seqid, gStart-maxDist, gEnd+maxDist):
+		start = max(gStart, gplexData.starts[gplex])
+		end = min(gEnd, gplexData.ends[gplex])
+		if (start-end) <= maxDist: gplexes.append(gplex)
+	return gplexes
+
+def writeTrack(trackPath, table, name):
+	"""Write the coverage of the entries of a file as a bedGraph file.
+	
+	:param trackPath: path where the bedGraph file should be written
+	:param table: GFFTable of the entries
+	:param name: name of the track
+	:return: nothing
+	"""
+	from Intervals import buildCoverage, coverageRuns
+	from Utils import openFile
+	
+	coverage = buildCoverage(table.intervals())
+	with openFile(trackPath, 'w') as trackFile:
+		trackFile.write('track type=bedGraph name="' + name + '"\n')
+		for seqid, _, _ in table.ranges():
+			for start, end, depth in coverageRuns(coverage, seqid):
+				trackFile.write(seqid + '\t' + str(start-1) + '\t' + str(end) + '\t' + str(depth) + '\n')
 
 # =============================================================================
 
@@ -90,6 +324,25 @@ if __name__ == '__main__':
 						help='minimum overlap required of non-aligned region (default=0.5)')
 	parser.add_argument('--maxDist', type=int, action='store', default=0,
 						help='max number of base pairs separating a gplex and gene (default=0)')
+	parser.add_argument('--workers', type=int, action='store', default=1,
+						help='number of processes that sequences are shared out to; 0 uses every CPU (default=1)')
+	parser.add_argument('--full', action='store_true',
+						help='recalculate every sequence, rather than only those whose entries changed since the last run')
+	parser.add_argument('--tracks', action='store_true',
+						help='also write the coverage of non-alignments and gplexes as bedGraph files')
+	parser.add_argument('--sweepMinCov', type=float, nargs='+', default=None,
+						help='sweep these minimum overlaps instead of filtering the files, writing the number of genes that pass each threshold to overlaps/sweep.tsv')
+	parser.add_argument('--sweepMaxDist', type=int, nargs='+', default=None,
+						help='sweep these max distances instead of filtering the files (default=maxDist)')
+	parser.add_argument('--cells', nargs='+', default=[],
+						help='minCov,maxDist pairs of a sweep whose filtered files should be written to overlaps/sweep/')
 	args = parser.parse_args()
 	
-	main(args.gffPath, args.gplexPath, args.nalPath, args.minCov, args.maxDist)
+	if args.cells and args.sweepMinCov is None and args.sweepMaxDist is None: parser.error('--cells requires --sweepMinCov and/or --sweepMaxDist')
+	if args.sweepMinCov is not None or args.sweepMaxDist is not None:
+		cells = [tuple(cell.split(',')) for cell in args.cells]
+		if any(len(cell) != 2 for cell in cells): parser.error('--cells must be given as minCov,maxDist pairs')
+		sweep(args.gffPath, args.gplexPath, args.nalPath, args.sweepMinCov or [args.minCov], args.sweepMaxDist or [args.maxDist],
+			cells, args.workers)
+	else:
+		main(args.gffPath, args.gplexPath, args.nalPath, args.minCov, args.maxDist, args.workers, not args.full, args.tracks)
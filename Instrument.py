@@ -0,0 +1,163 @@
+# =============================================================================
+# bmle
+# G4Pipeline: Instrument.py
+# Progress reporting, timing, memory and profiling of pipeline stages
+# =============================================================================
+
+import os
+
+settings = {
+	'interval': float(os.environ.get('G4_PROGRESS_INTERVAL', 5)),	# min seconds between progress lines
+	'tracemalloc': os.environ.get('G4_TRACEMALLOC', '0') == '1',	# whether to trace Python allocations per stage
+	'profileDir': os.environ.get('G4_PROFILE_DIR') or None,			# where to write cProfile stats of each stage
+}
+
+# Records of every stage run in this process
+report = {'stages': []}
+_active = []
+
+def configure(interval=None, tracemalloc=None, profileDir=None):
+	"""Change the instrumentation settings for the current process.
+
+	:param interval: min number of seconds between progress lines
+	:param tracemalloc: whether to trace the peak Python memory allocations of each stage
+	:param profileDir: directory where cProfile stats of each stage should be written
+	:return: nothing
+	"""
+	for key, value in (('interval', interval), ('tracemalloc', tracemalloc), ('profileDir', profileDir)):
+		if value is not None: settings[key] = value
+
+def progress(iterable, label, total=None):
+	"""Wrap an iterable to report how far through it the current stage is.
+
+	A line is printed at most once every settings['interval'] seconds, so large inputs
+	don't flood the terminal or log files.
+
+	:param iterable: the items to iterate over
+	:param label: a description of what is being iterated over
+	:param total: total number of items, if known
+	:return: a generator of the items of iterable
+	"""
+	import time
+
+	start = time.perf_counter()
+	nextReport = start + settings['interval']
+	count = 0
+	for item in iterable:
+		yield item
+		count += 1
+		if count & 1023 == 0 or total is not None:
+			now = time.perf_counter()
+			if now >= nextReport:
+				nextReport = now + settings['interval']
+				done = str(count) + (' of ' + str(total) if total is not None else '')
+				print('\t' + label + ': ' + done + ' (' + str(round(count / (now-start))) + '/s)', flush=True)
+
+def count(n):
+	"""Add to the number of records processed by the current stage.
+
+	:param n: number of records
+	:return: nothing
+	"""
+	if _active: _active[-1]['records'] = _active[-1].get('records', 0) + n
+
+def timed(name):
+	"""Decorate a function so that each call is recorded as a stage in the run report.
+
+	Records wall and CPU time, peak resident memory (where the platform reports it), the
+	number of records passed to count() and the resulting throughput, and optionally the
+	peak Python allocations (settings['tracemalloc']) and a cProfile dump (settings['profileDir']).
+
+	:param name: name of the stage
+	:return: a decorator
+	"""
+	import functools
+
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			import time
+			import tracemalloc
+			import cProfile
+
+			record = {'name': name}
+			if _active: record['parent'] = _active[-1]['name']
+			_active.append(record)
+			traced = settings['tracemalloc'] and not tracemalloc.is_tracing()
+			if traced: tracemalloc.start()
+			profiler = None
+			if settings['profileDir'] and len(_active) == 1:
+				profiler = cProfile.Profile()
+				profiler.enable()
+			wall = time.perf_counter()
+			cpu = time.process_time()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				record['wall'] = round(time.perf_counter() - wall, 4)
+				record['cpu'] = round(time.process_time() - cpu, 4)
+				record['maxRSS'] = _maxRSS()
+				record['maxRSSChildren'] = _maxRSS(children=True)
+				if 'records' in record and record['wall'] > 0: record['throughput'] = round(record['records'] / record['wall'], 2)
+				if traced:
+					record['tracemallocPeak'] = tracemalloc.get_traced_memory()[1]
+					tracemalloc.stop()
+				if profiler is not None:
+					profiler.disable()
+					os.makedirs(settings['profileDir'], exist_ok=True)
+					record['profile'] = os.path.join(settings['profileDir'], str(len(report['stages'])) + '_' + name + '.prof')
+					profiler.dump_stats(record['profile'])
+				_active.pop()
+				report['stages'].append(record)
+				rss = ', peak RSS ' + str(record['maxRSS'] // 1000000) + ' MB' if record['maxRSS'] is not None else ''
+				print('[' + name + '] ' + str(record['wall']) + ' s wall, ' + str(record['cpu']) + ' s CPU' + rss, flush=True)
+		return wrapper
+	return decorator
+
+def skipped(name):
+	"""Record a stage that was skipped.
+
+	:param name: name of the stage
+	:return: nothing
+	"""
+	report['stages'].append({'name': name, 'skipped': True})
+
+def writeReport(reportPath):
+	"""Write the records of every stage run in this process as a JSON file.
+
+	:param reportPath: path to the JSON file
+	:return: nothing
+	"""
+	import sys
+	import json
+	import platform
+
+	stages = [stage for stage in report['stages'] if not stage.get('skipped') and 'parent' not in stage]
+	toWrite = {'argv': sys.argv, 'python': platform.python_version(), 'cpus': os.cpu_count(),
+		'wall': round(sum(stage['wall'] for stage in stages), 4),
+		'cpu': round(sum(stage['cpu'] for stage in stages), 4),
+		'stages': report['stages']}
+	if os.path.dirname(reportPath): os.makedirs(os.path.dirname(reportPath), exist_ok=True)
+	with open(reportPath, 'w') as f: json.dump(toWrite, f, indent='\t')
+
+def reset():
+	"""Forget every recorded stage.
+
+	:return: nothing
+	"""
+	report['stages'] = []
+
+def _maxRSS(children=False):
+	"""Get the peak resident memory of this process or its children.
+
+	:param children: whether to get the peak of the child processes instead (default=False)
+	:return: peak resident memory in bytes, or None where the 'resource' module is unavailable (e.g. Windows)
+	"""
+	import sys
+	try:
+		import resource
+	except ImportError:
+		return None
+
+	rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+	return rss if sys.platform == 'darwin' else rss * 1024		# reported in KB on Linux
@@ -0,0 +1,253 @@
+# =============================================================================
+# bmle
+# G4Pipeline: Intervals.py
+# Per-sequence interval indexes for fast overlap queries on GFF entries
+# =============================================================================
+
+def buildIndex(intervals):
+	"""Build a per-sequence interval index.
+
+	Intervals of each sequence are sorted by start and end position and laid out
+	as an implicit augmented interval tree: every odd position of the sorted
+	arrays is an internal node that also stores the largest end position of its
+	subtree, so queries only descend into subtrees that can contain a hit.
+
+	:param intervals: an iterable of (seqid, start, end, value) tuples (1-based, inclusive coordinates)
+	:return: a dict mapping each seqid to its index
+	"""
+	from operator import itemgetter
+
+	grouped = {}
+	for seqid, start, end, value in intervals:
+		grouped.setdefault(seqid, []).append((start, end, value))
+
+	index = {}
+	for seqid, items in grouped.items():
+		items.sort(key=itemgetter(0, 1))	# stable, so ties keep their input order
+		starts = [item[0] for item in items]
+		ends = [item[1] for item in items]
+		values = [item[2] for item in items]
+		maxEnds, rootLevel = _augment(ends)
+		index[seqid] = (starts, ends, maxEnds, values, rootLevel)
+	return index
+
+def _augment(ends):
+	"""Compute the subtree maxima of an implicit interval tree.
+
+	:param ends: the end positions of the intervals, in sorted order
+	:return: a tuple of (list of subtree maxima, level of the root node)
+	"""
+	n = len(ends)
+	maxEnds = list(ends)
+	if n == 0: return maxEnds, -1
+
+	# Leaves sit at even positions; 'last' tracks the max end of the rightmost subtree
+	lastI = (n-1) & ~1
+	last = ends[lastI]
+	k = 1
+	while (1 << k) <= n:
+		x = 1 << (k-1)
+		for i in range((x << 1) - 1, n, x << 2):
+			right = maxEnds[i+x] if i+x < n else last
+			maxEnds[i] = max(ends[i], maxEnds[i-x], right)
+		lastI = lastI - x if (lastI >> k) & 1 else lastI + x
+		if lastI < n and maxEnds[lastI] > last: last = maxEnds[lastI]
+		k += 1
+	return maxEnds, k-1
+
+def overlapping(index, seqid, start, end):
+	"""Find all intervals on a sequence that overlap a region.
+
+	:param index: an index generated by buildIndex()
+	:param seqid: the sequence to search
+	:param start: start position of the region (1-based, inclusive)
+	:param end: end position of the region (1-based, inclusive)
+	:return: a list of the values of all overlapping intervals, in sorted order
+	"""
+	tree = index.get(seqid)
+	if tree is None: return []
+	starts, ends, maxEnds, values, rootLevel = tree
+	n = len(starts)
+	hits = []
+
+	# Top-down traversal; subtrees of at most 16 nodes are scanned linearly
+	stack = [((1 << rootLevel) - 1, rootLevel, False)]
+	while stack:
+		x, k, leftDone = stack.pop()
+		if k <= 3:
+			i = x >> k << k
+			i1 = min(i + (1 << (k+1)) - 1, n)
+			while i < i1 and starts[i] <= end:
+				if ends[i] >= start: hits.append(i)
+				i += 1
+		elif not leftDone:
+			y = x - (1 << (k-1))
+			stack.append((x, k, True))
+			if y >= n or maxEnds[y] >= start: stack.append((y, k-1, False))
+		elif x < n and starts[x] <= end:
+			if ends[x] >= start: hits.append(x)
+			stack.append((x + (1 << (k-1)), k-1, False))
+	return [values[i] for i in hits]
+
+def buildEndpointIndex(intervals):
+	"""Build a per-sequence index of interval endpoints for nearest-neighbour queries.
+
+	Start and end positions of each sequence are merged into one sorted array of
+	distinct positions, each paired with the first interval (in input order) that
+	begins or ends there.
+
+	:param intervals: an iterable of (seqid, start, end, value) tuples (1-based, inclusive coordinates)
+	:return: a dict mapping each seqid to its index
+	"""
+	grouped = {}
+	for seqid, start, end, value in intervals:
+		grouped.setdefault(seqid, []).append((start, end, value))
+
+	index = {}
+	for seqid, items in grouped.items():
+		firsts = {}
+		for i, (start, end, _) in enumerate(items):
+			firsts.setdefault(start, i)
+			firsts.setdefault(end, i)
+		positions = sorted(firsts)
+		index[seqid] = (positions, [firsts[p] for p in positions], [item[2] for item in items])
+	return index
+
+def nearest(index, seqid, start, end):
+	"""Find the interval with an endpoint closest to either endpoint of a region.
+
+	Ties are broken in favour of the interval that came first in the input, so the
+	result does not depend on how intervals are nested or overlap each other.
+
+	:param index: an index generated by buildEndpointIndex()
+	:param seqid: the sequence to search
+	:param start: start position of the region
+	:param end: end position of the region
+	:return: the value of the closest interval, or None if the sequence has no intervals
+	"""
+	from bisect import bisect_left
+
+	tree = index.get(seqid)
+	if tree is None: return None
+	positions, firsts, values = tree
+	n = len(positions)
+
+	# Smallest distance between an endpoint of the region and any interval endpoint
+	minDist = None
+	for pos in (start, end):
+		i = bisect_left(positions, pos)
+		for j in (i-1, i):
+			if 0 <= j < n:
+				dist = abs(positions[j] - pos)
+				if minDist is None or dist < minDist: minDist = dist
+
+	# First interval that has an endpoint at that distance
+	first = None
+	for target in (start-minDist, start+minDist, end-minDist, end+minDist):
+		i = bisect_left(positions, target)
+		if i < n and positions[i] == target and (first is None or firsts[i] < first): first = firsts[i]
+	return values[first]
+
+def buildCoverage(intervals):
+	"""Build per-sequence coverage tracks in a single sweep.
+
+	Every interval adds 1 to the depth at its start and removes 1 after its end, as in
+	a difference array; the running depth is only stored where it changes, along with
+	the number of covered bases before each change, so the covered bases of any region
+	take two lookups (see coveredBases()).
+
+	:param intervals: an iterable of (seqid, start, end, value) tuples (1-based, inclusive coordinates)
+	:return: a dict mapping each seqid to a tuple of (positions where the depth changes, depth from each position on,
+		number of bases covered at least once before each position)
+	"""
+	grouped = {}
+	for seqid, start, end, _ in intervals:
+		if end < start: continue
+		changes = grouped.setdefault(seqid, {})
+		changes[start] = changes.get(start, 0) + 1
+		changes[end+1] = changes.get(end+1, 0) - 1
+
+	coverage = {}
+	for seqid, changes in grouped.items():
+		positions = []
+		depths = []
+		covered = []
+		depth = 0
+		total = 0
+		for pos in sorted(changes):
+			if changes[pos] == 0: continue
+			if depth > 0: total += pos - positions[-1]
+			depth += changes[pos]
+			positions.append(pos)
+			depths.append(depth)
+			covered.append(total)
+		coverage[seqid] = (positions, depths, covered)
+	return coverage
+
+def coveredBases(coverage, seqid, start, end):
+	"""Count the bases of a region that are covered by at least one interval.
+
+	:param coverage: coverage tracks generated by buildCoverage()
+	:param seqid: the sequence of the region
+	:param start: start position of the region (1-based, inclusive)
+	:param end: end position of the region (1-based, inclusive)
+	:return: number of covered bases
+	"""
+	track = coverage.get(seqid)
+	if track is None or end < start: return 0
+	return _coveredBefore(track, end+1) - _coveredBefore(track, start)
+
+def _coveredBefore(track, pos):
+	"""Count the covered bases of a sequence before a position.
+
+	:param track: the coverage track of the sequence, as generated by buildCoverage()
+	:param pos: the position
+	:return: number of covered bases
+	"""
+	from bisect import bisect_right
+
+	positions, depths, covered = track
+	k = bisect_right(positions, pos) - 1
+	if k < 0: return 0
+	return covered[k] + (pos - positions[k] if depths[k] > 0 else 0)
+
+def coverageRuns(coverage, seqid):
+	"""Generate the runs of a sequence that are covered at a constant depth, e.g. for a bedGraph file.
+
+	:param coverage: coverage tracks generated by buildCoverage()
+	:param seqid: the sequence
+	:return: a generator of (start, end, depth) tuples (1-based, inclusive coordinates) of every covered run, in sorted order
+	"""
+	positions, depths, _ = coverage.get(seqid, ([], [], []))
+	for k in range(len(positions)-1):
+		if depths[k] > 0: yield (positions[k], positions[k+1]-1, depths[k])
+
+def mergeIntervals(intervals):
+	"""Merge overlapping intervals in a single sweep.
+
+	:param intervals: an iterable of (start, end) tuples sorted by start position (1-based, inclusive coordinates)
+	:return: a generator of merged (start, end) tuples, in sorted order
+	"""
+	current = None
+	for start, end in intervals:
+		if current is None:
+			current = [start, end]
+		elif start <= current[1]:
+			if end > current[1]: current[1] = end
+		else:
+			yield tuple(current)
+			current = [start, end]
+	if current is not None: yield tuple(current)
+
+def invertIntervals(intervals, seqLen):
+	"""Generate the gaps between merged intervals on a sequence.
+
+	:param intervals: an iterable of disjoint (start, end) tuples in sorted order (1-based, inclusive coordinates)
+	:param seqLen: length of the sequence
+	:return: a generator of (start, end) tuples covering every position not covered by intervals
+	"""
+	prevEnd = 0
+	for start, end in intervals:
+		if start > prevEnd+1: yield (prevEnd+1, start-1)
+		prevEnd = max(prevEnd, end)
+	if prevEnd < seqLen: yield (prevEnd+1, seqLen)
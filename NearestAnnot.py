@@ -4,147 +4,191 @@
 # Finds the nearest annotation to each Gplex
 # =============================================================================
 
-def generate(gplexPath, annotPath, dataPath):
+import Instrument
+
+# Types of annotation that gplexes are located relative to; others aren't loaded
+NEAREST_TYPES = ['CDS', 'gene', 'non-alignment']
+
+# Columns of the data file and their types; missing values are left empty
+COLUMNS = [('gplex_id', str), ('seqid', str), ('start', int), ('end', int), ('strand', str), ('annot_id', str),
+	('location', str), ('gplex_endpoint', str), ('annot_endpoint', str), ('distance', int), ('annot_strand', str)]
+
+# Header of the fixed-width report written by render()
+REPORT_HEADER = ['gplex-id', 'seq-id', 'start', 'end', 'gplex strand', 'closest annot', 'location', 'gplex start', 'annot end',
+	'distance (bp)', 'annot strand']
+
+@Instrument.timed('NearestAnnot.generate')
+def generate(gplexPath, annotPath, dataPath, workers=1, incremental=True):
 	"""Generate a data file listing nearest annotations for each gplex.
 
+		The data file is tab-separated, with a header row of the names of COLUMNS, and is
+		written row by row as each sequence is finished.
+
 		:param gplexPath: path to the GFF3-formatted gplex file
 		:param annotPath: path to the GFF3-formatted gene annotation file
 		:param dataPath: path to where the output data file should be written
+		:param workers: number of processes that sequences are shared out to; 0 uses every CPU (default=1)
+		:param incremental: if True, only recalculates sequences whose entries changed since the last run (default=True)
 		:return: writes a data file listing nearest annotations for each gplex
 	"""
 	import os
-	import math
-	from operator import itemgetter
-	from Utils import load
+	from Utils import loadTable, mapShards, mapChangedShards, openFile
 	print('\nGenerating data file...')
 	
 	# Loads data
 	print('Loading files...')
-	gplex = load(gplexPath)[2]
-	annot = load(annotPath)[2]
+	gplex = loadTable(gplexPath)[2]
+	annot = loadTable(annotPath, types=NEAREST_TYPES)[2]
 	
-	# Prepares list of closest ORFs
-	orfListData = []
-	orfListHeaders = [['gplex-id', 'seq-id', 'start', 'end', 'gplex strand', 'closest annot', 'location', 'gplex start', 'annot end', 'distance (bp)', 'annot strand']]
-
-	# Iterate over all gplex entries
+	# Splits the files into one shard per sequence
+	annotRanges = {seqid: (lo, hi) for seqid, lo, hi in annot.ranges()}
+	shards = []
+	for seqid, lo, hi in gplex.ranges():
+		alo, ahi = annotRanges.get(seqid, (0, 0))
+		shards.append((seqid, gplex.take(range(lo, hi)), annot.take(range(alo, ahi))))
+	
+	# Iterate over all gplex entries, writing the rows of each sequence as soon as they're found
 	print('Calculating stats for each G-quadruplex...')
-	l = len(gplex)
-	for i, line in enumerate(gplex):
-		print('\tCalculating ' + str(i+1) + ' of ' + str(l) + '...')
-		seqid = line[0]
-		start = int(line[3])
-		end = int(line[4])
-		strand = line[6]
-		ID = line[8][0][3:]		# placeholder name
-		for item in line[8]:	# properly checks for name
+	if incremental:
+		os.makedirs(os.path.dirname(dataPath), exist_ok=True)
+		gplexPrints = gplex.fingerprints()
+		annotPrints = annot.fingerprints()
+		fingerprints = [(gplexPrints.get(shard[0]), annotPrints.get(shard[0])) for shard in shards]
+		partialPath = os.path.join(os.path.dirname(dataPath), '.' + os.path.basename(dataPath) + '.partials.pkl')
+		results = mapChangedShards(findNearest, shards, fingerprints, partialPath, workers)
+	else:
+		results = mapShards(findNearest, shards, workers)
+	os.makedirs(os.path.dirname(dataPath), exist_ok=True)
+	count = 0
+	with openFile(dataPath, 'w') as dataFile:
+		dataFile.write('\t'.join(name for name, _ in COLUMNS) + '\n')
+		for rows in Instrument.progress(results, 'Sequences', total=len(shards)):
+			for row in rows: dataFile.write('\t'.join('' if value is None else str(value) for value in row) + '\n')
+			count += len(rows)
+	Instrument.count(count)
+	print('Finished writing to ' + dataPath)
+	print('Finished generating data file!\n')
+
+def findNearest(shard):
+	"""Find the nearest annotation to each gplex of a single sequence.
+	
+	:param shard: a tuple of (seqid, GFFTable of gplexes, GFFTable of annotations), where both tables only hold entries of that sequence,
+		and the annotations only hold entries of NEAREST_TYPES
+	:return: a list of rows of the data file, one per gplex (see COLUMNS); values that don't apply are None
+	"""
+	from Intervals import buildEndpointIndex, nearest
+	
+	seqid, gplex, annot = shard
+	
+	# Indexes the endpoints of annotations
+	annotIndex = buildEndpointIndex(annot.intervals())
+	
+	orfListData = []
+	for _, start, end, i in gplex.intervals():
+		strand = gplex.field(i, 6)
+		attributes = gplex.attributes(i)
+		ID = attributes[0][3:]		# placeholder name
+		for item in attributes:		# properly checks for name
 			if item.startswith(('ID', 'id', 'Name', 'name')):
 				ID = item.split('=')[1]
 				break
 		
-		# Calculates distance to the nearest annotation
-		minDist = math.inf
-		pos = 'n/a'
-		annotid = 'n/a'
-		annotStrand = 'n/a'
-		
-		# Iterate over every annotation
-		keywords = ['CDS', 'gene', 'non-alignment']
-		gen = (line for line in annot if (line[0]==seqid and line[2] in keywords))
-		for annotLine in gen:
-			dis = {'5\'-5\'': int(annotLine[3]) - start,
-				'3\'-5\'': int(annotLine[3]) - end,
-				'5\'-3\'': int(annotLine[4]) - start,
-				'3\'-3\'': int(annotLine[4]) - end}
-			key = min({k: abs(v) for k,v in dis.items()}.items(), key=itemgetter(1))[0]
-			val = dis[key]
-			
-			# If the distance to this annotation is smaller than the currently-recorded annotation, replace the old annot with this one
-			if abs(val) < abs(minDist):
-				minDist = val
-				pos = key
-				annotid = annotLine[8][0][3:]
-				annotStrand = annotLine[6]
-			# This works because $gen (and $annot) are sorted by start + end
-			# positions, so any successive entries will only get further away
-			elif abs(val) > abs(minDist):
-				break
-		
-		# Calculates location relative to its nearest annotation
+		# Finds the annotation with the closest endpoint, and the location relative to it
+		j = nearest(annotIndex, seqid, start, end)
+		if j is None:
+			orfListData.append([ID, seqid, start, end, strand, None, 'n/a', None, None, None, None])
+			continue
+		pos, minDist, location = relativeLocation(start, end, annot.starts[j], annot.ends[j])
 		temp = pos.split('-')
-		if temp[0] == 'n/a':
-			location = 'n/a (no annotations on this sequence)'
-			temp.append('n/a')
-		elif temp[0] == temp[1]: location = 'Overlap'
-		elif temp[0] == '3\'' and temp[1] == '5\'' and minDist > 0: location = 'Upstream'
-		elif temp[0] == '5\'' and temp[1] == '3\'' and minDist < 0: location = 'Downstream'
-		else: location = 'Overlap'
 
 		# Appends nearest annot for this g-plex to the list of annot information
-		orfListData.append([ID, seqid, start, end, strand, annotid, location, temp[0], temp[1], minDist, annotStrand])
+		orfListData.append([ID, seqid, start, end, strand, annot.attributes(j)[0][3:], location, temp[0], temp[1], minDist, annot.field(j, 6)])
+	return orfListData
+
+def relativeLocation(start, end, annotStart, annotEnd):
+	"""Locate a region relative to an annotation, by their closest pair of endpoints.
 	
-	# Writes orfList to output file
-	print('Writing to file...')
-	orfList = orfListHeaders + orfListData
-	os.makedirs(os.path.dirname(dataPath), exist_ok=True)
+	:param start: start position of the region
+	:param end: end position of the region
+	:param annotStart: start position of the annotation
+	:param annotEnd: end position of the annotation
+	:return: a tuple of (closest endpoints of the region and annotation, e.g. "3'-5'", signed distance between them,
+		location of the region: 'Upstream', 'Overlap' or 'Downstream')
+	"""
+	from operator import itemgetter
 	
-	with open(dataPath, 'w') as stats:
-		col_width = [max(len(str(x)) + 2 for x in line) for line in zip(*orfList)]
-		for row in orfList:	stats.write(''.join(str(word).ljust(col_width[i]) for i, word in enumerate(row)).rstrip() + '\n')
-	print('Finished writing to ' + dataPath)
-	print('Finished generating data file!\n')
+	dis = {'5\'-5\'': annotStart - start,
+		'3\'-5\'': annotStart - end,
+		'5\'-3\'': annotEnd - start,
+		'3\'-3\'': annotEnd - end}
+	pos = min({k: abs(v) for k,v in dis.items()}.items(), key=itemgetter(1))[0]
+	minDist = dis[pos]
 	
+	# Calculates location relative to the annotation
+	temp = pos.split('-')
+	if temp[0] == temp[1]: location = 'Overlap'
+	elif temp[0] == '3\'' and temp[1] == '5\'' and minDist > 0: location = 'Upstream'
+	elif temp[0] == '5\'' and temp[1] == '3\'' and minDist < 0: location = 'Downstream'
+	else: location = 'Overlap'
+	return pos, minDist, location
 
-def summarize(dataPath, fastaPath):
+@Instrument.timed('NearestAnnot.summarize')
+def summarize(dataPath, fastaPath, seqidIndex=None):
 	"""Generate summary statistics for the data file previously written.
 	
+	The data file is streamed, and the summary is written next to it, ending in '_summary.txt'.
+	
 	:param dataPath: path to where the output data file is written
 	:param fastaPath: path to the FASTA-formatted genomic sequence file
+	:param seqidIndex: position of the sequence label within each FASTA header (default=asks the user)
 	:return: writes a summary file based off the data file generated by generate()
 	"""
 	import os
-	from Utils import generateSeqRegs
+	from Utils import generateSeqRegs, openFile
 	print('\nGenerating summary file...')
 	
+	# Tallies every statistic of each sequence region in a single pass:
+	# [gplexes, sense, antisense, upstream, overlap, downstream, n/a, sum of non-overlapping distances, non-overlapping gplexes]
+	seqregs = [line.split(' ')[1] for line in generateSeqRegs(fastaPath, seqidIndex)]
+	stats = {seq: [0, 0, 0, 0, 0, 0, 0, 0, 0] for seq in seqregs}
+	strandCols = {'+': 1, '-': 2}
+	locCols = {'Upstream': 3, 'Overlap': 4, 'Downstream': 5, 'n/a': 6}
 	print('Loading data...')
-	data = []
-	with open(dataPath, 'r') as dataFile:
-		next(dataFile)	# skips header row
-		for line in dataFile:
-			temp = line.split()
-			temp[9] = int(temp[9]) if temp[9]!='on' else temp[9]
-			data.append(temp)
-
-	# Separates contents based on sequence regions
-	dictlol = {}
-	seqregs = [line.split(' ')[1] for line in generateSeqRegs(fastaPath)]
-	for seq in seqregs:	dictlol[seq] = [row for row in data if row[1] == seq]
+	rows = 0
+	for row in readData(dataPath):
+		rows += 1
+		counts = stats.get(row[1])
+		if counts is None: continue
+		counts[0] += 1
+		if row[4] in strandCols: counts[strandCols[row[4]]] += 1
+		location = row[6]
+		counts[locCols[location]] += 1
+		if location != 'Overlap' and location != 'n/a':
+			counts[7] += abs(row[9])
+			counts[8] += 1
+	Instrument.count(rows)
 	
 	# Writes to file
-	temp = os.path.splitext(dataPath)
-	summaryPath = temp[0] + '_summary' + temp[1]
-	with open(summaryPath, 'w') as sumFile:
+	summaryPath = os.path.splitext(dataPath[:-3] if dataPath.endswith('.gz') else dataPath)[0] + '_summary.txt'
+	with openFile(summaryPath, 'w') as sumFile:
 		
 		# ---------------------------------------------------------------------
 		# Calculates total number of gplexes
 		# ---------------------------------------------------------------------
 		print('Calculating total number of G-quadruplexes...')
-		countORFs = {key: len(value) for key, value in dictlol.items()}
-		totalORFs = str(sum([value for key, value in countORFs.items()]))
-		sumFile.write('Total number of G-quadruplexes:\n\tAll sequences: ' + totalORFs + '\n' + '\n'.join(['\t' + key + ': ' + str(value) for key, value in countORFs.items()]) + '\n\n')
+		totalORFs = str(sum(counts[0] for counts in stats.values()))
+		sumFile.write('Total number of G-quadruplexes:\n\tAll sequences: ' + totalORFs + '\n' + '\n'.join(['\t' + key + ': ' + str(counts[0]) for key, counts in stats.items()]) + '\n\n')
 		
 		# ---------------------------------------------------------------------
 		# Calculates strandedness of gplexes
 		# ---------------------------------------------------------------------
 		print('Calculating strandedness of G-quadruplexes...')
 		toWrite = []
-		signs = ['+', '-']
 		totals = [0, 0]
 		
 		# Iterates over all sequences
-		for key, value in dictlol.items():
-			strands = []
-			for s in signs: strands.append(sum(1 for x in value if x[4]==s))
+		for key, counts in stats.items():
+			strands = counts[1:3]
 			sums = sum(strands)
 			totals[0] += strands[0]
 			totals[1] += strands[1]
@@ -177,25 +221,20 @@ def summarize(dataPath, fastaPath):
 		count = 0
 		
 		# Calculates averages for each sequence
-		def mean(a): return round(sum(map(abs, a)) / len(a), 2)
-		for key, value in dictlol.items():
-			if not value:
+		for key, counts in stats.items():
+			if counts[0] == 0:
 				distances.append([key + ':', 'n/a (no g-quadruplexes on this sequence)'])
+			elif counts[6] > 0:
+				distances.append([key+':', 'n/a (no annotations for this sequence)'])
+			elif counts[8] == 0:
+				distances.append([key+':', 'n/a (no non-overlapping g-quadruplexes)'])
 			else:
-				naList = list(zip(*[item for item in value if item[6] == 'n/a']))
-				if naList:
-					distances.append([key+':', 'n/a (no annotations for this sequence)'])
-				else:
-					tempList = list(zip(*[item for item in value if item[6]!='Overlap']))
-					if not tempList:
-						distances.append([key+':', 'n/a (no non-overlapping g-quadruplexes)'])
-					else:
-						distances.append([key+':', str(mean(tempList[9])) + ' bp'])
-						sumAll += sum(map(abs, tempList[9]))
-						count += len(tempList[9])
+				distances.append([key+':', str(round(counts[7] / counts[8], 2)) + ' bp'])
+				sumAll += counts[7]
+				count += counts[8]
 		
 		# Calculates average across all sequences
-		distances.insert(0, ['All sequences:', str(round(sumAll/count,2)) + ' bp'])
+		distances.insert(0, ['All sequences:', str(round(sumAll/count,2)) + ' bp' if count else 'n/a (no non-overlapping g-quadruplexes)'])
 		
 		# Writes everything
 		width = [max(len(str(x))+1 for x in col) for col in zip(*distances)]
@@ -207,25 +246,24 @@ def summarize(dataPath, fastaPath):
 		# Calculates relative locations of G-quadruplexes
 		# ---------------------------------------------------------------------
 		print('Calculating relative locations of G-quadruplexes...')
-		locs = ['Upstream', 'Overlap', 'Downstream', 'n/a']
 		toWrite = []
-		sumAll = [0 for _ in locs]
+		sumAll = [0, 0, 0, 0]
 		
 		# Calculates locations for each sequence
-		for key, value in dictlol.items():
-			counts = [sum(1 for x in value if x[6] == loc) for loc in locs]
-			tempSum = sum(counts)
-			for i in range(len(locs)): sumAll[i] += counts[i]
+		for key, counts in stats.items():
+			locCounts = counts[3:7]
+			tempSum = sum(locCounts)
+			for i in range(len(locCounts)): sumAll[i] += locCounts[i]
 			
 			if tempSum == 0:
 				toWrite.append([key+':', 'n/a (no G-quadruplexes in this sequence)', '', '', ''])
-			elif counts[3] > 0:
+			elif locCounts[3] > 0:
 				toWrite.append([key+':', 'n/a (no annotations in this sequence)', '', '', ''])
 			else:
-				percents = [str(round(count / tempSum * 100, 2)) for count in counts]
-				toWrite.append([key+':', 'Upstream:  ', str(counts[0]), str(tempSum), percents[0]])
-				toWrite.append([' '*(len(key)+1), 'Overlap:   ', str(counts[1]), str(tempSum), percents[1]])
-				toWrite.append([' '*(len(key)+1), 'Downstream:', str(counts[2]), str(tempSum), percents[2]])
+				percents = [str(round(count / tempSum * 100, 2)) for count in locCounts]
+				toWrite.append([key+':', 'Upstream:  ', str(locCounts[0]), str(tempSum), percents[0]])
+				toWrite.append([' '*(len(key)+1), 'Overlap:   ', str(locCounts[1]), str(tempSum), percents[1]])
+				toWrite.append([' '*(len(key)+1), 'Downstream:', str(locCounts[2]), str(tempSum), percents[2]])
 			
 		# Calculates locations for all sequences
 		sumTotal = sum(sumAll)
@@ -246,6 +284,62 @@ def summarize(dataPath, fastaPath):
 	print('Finished generating summary file!\n')
 
 
+def readData(dataPath):
+	"""Read the data file written by generate(), one row at a time.
+	
+	The file can also be read by e.g. pandas.read_csv(dataPath, sep='\\t').
+	
+	:param dataPath: path to the data file
+	:return: a generator of rows, with values of the types in COLUMNS; missing values are None
+	"""
+	from Utils import openFile
+	
+	types = [typ for _, typ in COLUMNS]
+	with openFile(dataPath, 'r') as dataFile:
+		next(dataFile)	# skips header row
+		for line in dataFile:
+			yield [typ(value) if value else None for typ, value in zip(types, line.rstrip('\n').split('\t'))]
+
+@Instrument.timed('NearestAnnot.render')
+def render(dataPath, reportPath=None):
+	"""Render the data file written by generate() as a fixed-width text report.
+	
+	The data file is read twice, first to find the width of each column and then to write
+	the report, so only one row is held in memory at a time.
+	
+	:param dataPath: path to the data file
+	:param reportPath: path where the report should be written (default=next to dataPath, ending in '.txt')
+	:return: writes a report listing nearest annotations for each gplex
+	"""
+	import os
+	from Utils import openFile
+	print('\nRendering report...')
+	
+	if reportPath is None: reportPath = os.path.splitext(dataPath[:-3] if dataPath.endswith('.gz') else dataPath)[0] + '.txt'
+	if os.path.abspath(reportPath) == os.path.abspath(dataPath): raise ValueError('The report would overwrite ' + dataPath + '; please specify a different report path!')
+	widths = [len(name) + 2 for name in REPORT_HEADER]
+	for row in readData(dataPath):
+		for i, word in enumerate(_reportRow(row)): widths[i] = max(widths[i], len(word) + 2)
+	
+	count = 0
+	with openFile(reportPath, 'w') as report:
+		report.write(''.join(word.ljust(widths[i]) for i, word in enumerate(REPORT_HEADER)).rstrip() + '\n')
+		for row in readData(dataPath):
+			report.write(''.join(word.ljust(widths[i]) for i, word in enumerate(_reportRow(row))).rstrip() + '\n')
+			count += 1
+	Instrument.count(count)
+	print('Finished writing to ' + reportPath + '\nFinished!\n')
+
+def _reportRow(row):
+	"""Format a row of the data file for the report written by render().
+	
+	:param row: a row, as read by readData()
+	:return: a list of strings
+	"""
+	if row[6] == 'n/a':
+		return [str(value) for value in row[:5]] + ['n/a', 'n/a (no annotations on this sequence)', 'n/a', 'n/a', 'inf', 'n/a']
+	return [str(value) for value in row]
+
 def writer(fileObj, header, lol):
 	"""Write the contents of a list of lists to fileObj
 	
@@ -275,12 +369,19 @@ if __name__ == '__main__':
 	parser.add_argument('annotPath',
 						help='path to the GFF-formatted gene annotation file')
 	parser.add_argument('dataPath',
-						help='path to where the output data file should be written')
+						help='path to where the tab-separated data file should be written')
 	parser.add_argument('fastaPath',
 						help='path to the FASTA-formatted genomic sequence file')
-	parser.add_argument('summaryPath',
-						help='path to where the output summary file should be written')
+	parser.add_argument('--seqidIndex', type=int, action='store', default=None,
+						help='position of the sequence label within each FASTA header (default=asks the user)')
+	parser.add_argument('--workers', type=int, action='store', default=1,
+						help='number of processes that sequences are shared out to; 0 uses every CPU (default=1)')
+	parser.add_argument('--full', action='store_true',
+						help='recalculate every sequence, rather than only those whose entries changed since the last run')
+	parser.add_argument('--report', action='store_true',
+						help='also render the data file as a fixed-width text report, next to it ending in \'.txt\'')
 	args = parser.parse_args()
 	
-	generate(args.gplexPath, args.annotPath, args.dataPath)
-	summarize(args.dataPath, args.fastaPath, args.summaryPath)
\ No newline at end of file
+	generate(args.gplexPath, args.annotPath, args.dataPath, args.workers, not args.full)
+	summarize(args.dataPath, args.fastaPath, args.seqidIndex)
+	if args.report: render(args.dataPath)
\ No newline at end of file
@@ -4,74 +4,118 @@
 # Generates a 'non-alignment' file from a SAM file
 # =============================================================================
 
-def main(alignPath):
+import Instrument
+
+@Instrument.timed('NonAlignments')
+def main(alignPath, workers=1, genomePath=None, seqidIndex=None, renamedPath=None):
 	"""Generate a GFF3 file of non-aligned regions from a SAM alignment file.
 	
+	If genomePath is given, blastn's 'Query_#' sequence names are replaced by the actual
+	sequence names while the file is read, in the same pass that extracts the alignments.
+	
 	:param alignPath: path to the SAM-formatted blastn alignment file
+	:param workers: number of processes that sequences are shared out to; 0 uses every CPU (default=1)
+	:param genomePath: path to the FASTA-formatted query genome file that alignPath was based off of (default=no renaming)
+	:param seqidIndex: position of the sequence label within each FASTA header (default=asks the user)
+	:param renamedPath: path where the renamed SAM file should be written; may be alignPath itself (default=not written)
 	:return: writes a GFF3 file of non-alignments to the same directory as alignPath
 	"""
-	import re
-	from operator import itemgetter
+	import os
+	from Cache import cached
+	from Utils import mapShards, openFile, derivePath, queryNames, isCompressed
 	print('\nGenerating non-alignments...')
 	
-	# Loads alignments from SAM file
 	print('Loading data...')
-	entries = []
-	seqs = {}
-	with open(alignPath, 'r') as alignFile:
-		for line in alignFile:
-			temp = line.split('\t')
-			if not line.startswith('@'):
-				entries.append(temp)
-			elif line.startswith('@SQ'):
-				seqs[temp[1][3:]] = temp[2][3:]
+	names = queryNames(genomePath, seqidIndex) if genomePath else None
+	if renamedPath is None:
+		seqs, data = cached(readAlignments, alignPath, names)
+	else:
+		# Writes to a temporary file first, as renamedPath may be the file being read
+		tempPath = renamedPath + '.tmp'
+		compress = renamedPath.endswith('.gz') or (os.path.abspath(renamedPath) == os.path.abspath(alignPath) and isCompressed(alignPath))
+		with openFile(tempPath, 'w', compress) as renamedFile:
+			seqs, data = readAlignments(alignPath, names, renamedFile)
+		os.replace(tempPath, renamedPath)
 	
-	# Extracts coordinates of aligned sequences
-	print('Extracting coordinates...')
-	data = {k: [] for k in seqs}
-	for line in entries:
-		start = int(line[3])
-		end = start + sum(map(int, re.findall('(\d+)(?=[MDNX=])', line[5]))) - 1
-		data[line[2]].append((start, end))
-	for k,v in data.items(): sorted(v, key=itemgetter(0))
-
-	# Merges coordinates of overlapping aligned sequences
-	print('Merging coordinates...')
-	for k,v in data.items():
-		i = 1
-		while i < len(v):
-			a = tuple([int(x) for x in v[i-1]])
-			b = tuple([int(x) for x in v[i]])
-			if not a[0] > b[1] and not a[1] < b[0]:
-				data[k].remove(a)
-				data[k].remove(b)
-				data[k].insert(i-1, (min(a[0],b[0]), max(a[1],b[1])))
-			else: i += 1
-			
-		# Adds filler annotations to beginning and end of sequence
-		seqLen = str(int(seqs[k])+1)
-		data[k].insert(0, (0, 0))
-		data[k].append((seqLen, seqLen))
-		
-	# Inverts coordinates
-	print('Inverting coordinates...')
-	nalign = []
-	for k,v in data.items():
-		for i in range(1, len(v)):
-			a = v[i-1]
-			b = v[i]
-			nalign.append((k, int(a[1])+1, int(b[0])-1))
+	# Merges and inverts the coordinates of each sequence
+	print('Merging and inverting coordinates...')
+	shards = [(k, data[k], int(v)) for k,v in seqs.items()]
+	nalign = Instrument.progress(mapShards(findGaps, shards, workers), 'Sequences', total=len(shards))
 	
 	# Writes to GFF file
 	print('Writing to file...')
-	outputPath = alignPath[:-3] + 'gff3'
-	with open(outputPath, 'w') as outFile:
+	outputPath = derivePath(alignPath, 'gff3')
+	with openFile(outputPath, 'w') as outFile:
 		outFile.write('##gff-version 3\n')
-		for k,v in seqs.items(): outFile.write('##sequence-region ' + k + ' 1 ' + v)
-		for i, item in enumerate(nalign):
-			outFile.write(item[0] + '\tblastn\tnon-alignment\t' + str(item[1]) + '\t' + str(item[2]) + '\t.\t.\t.\tID=nal_' + str(i) + ';Name=nal_' + str(i) + ';Start=' + str(item[1]) + ';End=' + str(item[2]) + '\n')
+		for k,v in seqs.items(): outFile.write('##sequence-region ' + k + ' 1 ' + v + '\n')
+		i = 0
+		for k, gaps in zip(seqs, nalign):
+			for start, end in gaps:
+				outFile.write(k + '\tblastn\tnon-alignment\t' + str(start) + '\t' + str(end) + '\t.\t.\t.\tID=nal_' + str(i) + ';Name=nal_' + str(i) + ';Start=' + str(start) + ';End=' + str(end) + '\n')
+				i += 1
 	
 	print('Finished writing to ' + outputPath + '\nFinished!\n')
+
+def findGaps(shard):
+	"""Find the non-aligned regions of a single sequence.
+	
+	:param shard: a tuple of (seqid, list of (start, end) tuples of aligned regions, sequence length)
+	:return: a list of (start, end) tuples of non-aligned regions, in sorted order
+	"""
+	from Intervals import mergeIntervals, invertIntervals
+	
+	seqid, coords, seqLen = shard
+	return list(invertIntervals(mergeIntervals(sorted(coords)), seqLen))
+
+def readAlignments(alignPath, names=None, renamedFile=None):
+	"""Read the merged coordinates of aligned sequences from a SAM alignment file.
+	
+	:param alignPath: path to the SAM-formatted blastn alignment file
+	:param names: a lookup table of SAM fields to rename, as generated by Utils.queryNames() (default=no renaming)
+	:param renamedFile: a file object that the (renamed) SAM file should be written to (default=not written)
+	:return: a tuple of (dict of sequence names to lengths, dict of sequence names to lists of (start, end) tuples of aligned regions)
+	"""
+	import re
+	from Intervals import mergeIntervals
+	from Utils import openFile
+	
+	# Streams alignments from SAM file, keeping only the coordinates of aligned sequences
+	cigarPattern = re.compile(r'(\d+)(?=[MDNX=])')
+	seqs = {}
+	data = {}
+	limits = {}
+	batch = []
+	count = 0
+	with openFile(alignPath, 'r') as alignFile:
+		for line in Instrument.progress(alignFile, 'Reading alignments'):
+			temp = line.strip().split('\t')
+			if names is not None: temp = [names.get(field, field) for field in temp]
+			if renamedFile is not None:
+				batch.append('\t'.join(temp))
+				if len(batch) >= 65536:
+					renamedFile.write('\n'.join(batch) + '\n')
+					batch = []
+			
+			if line.startswith('@SQ'):
+				fields = dict((field[:3], field[3:]) for field in temp[1:])
+				seqs[fields['SN:']] = fields['LN:']
+				data[fields['SN:']] = []
+				limits[fields['SN:']] = 4096
+			elif not line.startswith('@') and len(temp) > 5 and temp[2] in data:
+				start = int(temp[3])
+				end = start + sum(map(int, cigarPattern.findall(temp[5]))) - 1
+				coords = data[temp[2]]
+				coords.append((start, end))
+				count += 1
+				
+				# Merges coordinates of overlapping aligned sequences once enough have accumulated,
+				# so memory scales with the number of merged intervals rather than with the alignments
+				if len(coords) >= limits[temp[2]]:
+					coords[:] = mergeIntervals(sorted(coords))
+					limits[temp[2]] = max(4096, 2*len(coords))
+	if batch: renamedFile.write('\n'.join(batch) + '\n')
+	Instrument.count(count)
+	return seqs, data
 	
 # =============================================================================
 
@@ -82,6 +126,14 @@ if __name__ == '__main__':
 		description='Generates a GFF file of non-aligned regions from a SAM alignment file.')
 	parser.add_argument('alignPath',
 						help='path to the SAM-formatted blastn alignment file')
+	parser.add_argument('--workers', type=int, action='store', default=1,
+						help='number of processes that sequences are shared out to; 0 uses every CPU (default=1)')
+	parser.add_argument('--genomePath',
+						help='path to the FASTA-formatted query genome file, to replace blastn\'s \'Query_#\' sequence names')
+	parser.add_argument('--seqidIndex', type=int, action='store', default=None,
+						help='position of the sequence label within each FASTA header (default=asks the user)')
+	parser.add_argument('--renamedPath',
+						help='path where the renamed SAM file should be written; may be alignPath itself')
 	args = parser.parse_args()
 	
-	main(args.alignPath)
\ No newline at end of file
+	main(args.alignPath, args.workers, args.genomePath, args.seqidIndex, args.renamedPath)
\ No newline at end of file
@@ -4,58 +4,316 @@
 # A wrapper module to run through all modules in the G4 annotation pipeline
 # =============================================================================
 
+# Settings of a pipeline run; paths are relative to 'prefix'
+DEFAULTS = {
+	'prefix': '',			# directory containing all files
+	'fasta': None,			# genomic FASTA file
+	'annot': None,			# genomic annotation GFF/GFF3 file
+	'bed': None,			# QuadBase2 Tetraplex Finder BED file; if not given, G-quadruplexes are found by G4Finder.py
+	'sam': None,			# blastn SAM file
+	'renamedSam': None,		# where to write the SAM file with blastn's 'Query_#' names replaced; may be 'sam' itself
+	'seqidIndex': None,		# position of the sequence label within each FASTA header
+	'minCov': 0.5,			# see GeneOverlap.main()
+	'maxDist': 0,			# see GeneOverlap.main()
+	'minRun': 3,			# see G4Finder.main()
+	'maxRun': 7,			# see G4Finder.main()
+	'minLoop': 1,			# see G4Finder.main()
+	'maxLoop': 7,			# see G4Finder.main()
+	'sequences': False,		# whether to also write the overlapping genes, non-alignments and gplexes with their sequences
+	'flank': 0,				# size of the flanking windows written with them; see Sequences.annotate()
+	'tracks': False,		# whether to also write the coverage of non-alignments and gplexes as bedGraph files
+	'report': False,		# whether to also render the analysis data files as fixed-width text reports
+	'workers': 1,			# number of processes that sequences are shared out to; 0 uses every CPU
+	'compress': False,		# whether derived GFF files are written gzip-compressed
+	'profile': False,		# whether to write cProfile stats of each stage to '<prefix>/profiles/'
+	'tracemalloc': False,	# whether to trace the peak Python memory allocations of each stage
+}
+
 def main():
+	"""Run the pipeline interactively, asking for the location of every file.
+
+	:return: nothing
+	"""
+	config = dict(DEFAULTS)
+	config['prefix'] = input('Path to directory containing all files: ')
+	config['fasta'] = input('Filename of genomic FASTA file: ')
+	config['annot'] = input('Filename of genomic annotation GFF file: ')
+	config['bed'] = input('Filename of QuadBase2 Tetraplex Finder BED file (leave blank to find G-quadruplexes from the FASTA file): ') or None
+	config['sam'] = input('Filename of blastn SAM file: ')
+	run(config)
+
+def run(config, force=False):
+	"""Run every stage of the pipeline whose outputs are missing or out of date.
+
+	A stage is skipped if its parameters and the state of its input and output files
+	are the same as when it last finished; this is recorded in a stamp file under
+	'<prefix>/.g4pipeline/'. The timing and memory use of every stage is written to
+	'<prefix>/run_report.json'.
+
+	:param config: a dict of settings for the run (see DEFAULTS)
+	:param force: if True, runs every stage regardless of its stamp (default=False)
+	:return: nothing
+	"""
+	import os
+	import Instrument
+
+	settings = prepare(config)
+	Instrument.reset()
+	for stage in buildStages(settings): runStage(stage, settings, force)
+	Instrument.writeReport(os.path.join(settings['prefix'], 'run_report.json'))
+
+def prepare(config):
+	"""Complete the settings of a run and apply them to the current process.
+
+	:param config: a dict of settings for the run (see DEFAULTS)
+	:return: a dict of every setting
+	"""
+	import os
+	import Utils
+	import Instrument
+
+	settings = dict(DEFAULTS)
+	settings.update(config)
+	missing = [key for key in ('fasta', 'annot', 'sam') if not settings[key]]
+	if missing: raise ValueError('Missing settings for pipeline run: ' + ', '.join(missing))
+	Utils.settings['compress'] = settings['compress']
+	Instrument.configure(tracemalloc=settings['tracemalloc'],
+		profileDir=os.path.join(settings['prefix'], 'profiles') if settings['profile'] else None)
+	return settings
+
+def runStage(stage, settings, force=False):
+	"""Run a single stage, unless it is up to date.
+
+	:param stage: a stage generated by buildStages()
+	:param settings: the settings of the run, as returned by prepare()
+	:param force: if True, runs the stage regardless of its stamp (default=False)
+	:return: True if the stage was run, False if it was skipped
+	"""
+	import os
+	import Instrument
+
+	stampDir = os.path.join(settings['prefix'], '.g4pipeline')
+	if not force and isUpToDate(stage, stampDir):
+		print('Skipping ' + stage['name'] + ' (up to date)')
+		Instrument.skipped(stage['name'])
+		return False
+	stage['run']()
+	writeStamp(stage, stampDir)
+	return True
+
+def buildStages(config):
+	"""Build the graph of pipeline stages, in the order they must be run.
+
+	:param config: a dict of settings for the run (see DEFAULTS)
+	:return: a list of stages, each a dict of 'name', 'inputs', 'outputs', 'params' and 'run'
+	"""
+	import os
 	import Utils
 	import BedToGFF
+	import G4Finder
+	import Sequences
 	import NearestAnnot
 	import NonAlignments
 	import GeneOverlap
-	
+
+	prefix = config['prefix']
+	if prefix and not prefix.endswith('/'): prefix += '/'
+	fasta = prefix + config['fasta']
+	annot = prefix + config['annot']
+	sam = prefix + config['sam']
+	seqidIndex = config['seqidIndex']
+	stages = []
+
 	# =========================================================================
 	# File input and formatting modules
 	# =========================================================================
-	
-	prefix = input('Path to directory containing all files: ')
-	if not prefix.endswith('/'): prefix += '/'
-	
-	fasta = prefix + input('Filename of genomic FASTA file: ')
-	
-	annot = prefix + input('Filename of genomic annotation GFF file: ')
-	if annot.endswith('.gff'):
-		with open(prefix + annot, 'r') as f:
+
+	if annot.endswith(('.gff', '.gff.gz')):
+		with Utils.openFile(annot, 'r') as f:
 			if not f.readline().startswith('##'):
-				Utils.reformatGFF(annot, fasta)
-				annot += '3'
-	
-	qb = prefix + input('Filename of QuadBase2 Tetraplex Finder BED file: ')
-	BedToGFF.reformatBED(qb, fasta)
-	gplex = qb[:-3] + 'gff3'
-	
-	sam = prefix + input('Filename of blastn SAM file: ')
-	Utils.reformatSAM(sam, fasta)
-	
+				stages.append({'name': 'reformatGFF', 'inputs': [annot, fasta], 'outputs': [Utils.derivePath(annot, 'gff3')],
+					'params': {'seqidIndex': seqidIndex},
+					'run': lambda path=annot: Utils.reformatGFF(path, fasta, seqidIndex)})
+				annot = Utils.derivePath(annot, 'gff3')
+
+	if config['bed']:
+		bed = prefix + config['bed']
+		gplex = Utils.derivePath(bed, 'gff3')
+		stages.append({'name': 'reformatBED', 'inputs': [bed, fasta], 'outputs': [gplex],
+			'params': {'seqidIndex': seqidIndex},
+			'run': lambda: BedToGFF.reformatBED(bed, fasta, seqidIndex)})
+	else:
+		gplex = Utils.derivePath(fasta, 'g4.gff3')
+		motif = {key: config[key] for key in ('minRun', 'maxRun', 'minLoop', 'maxLoop')}
+		stages.append({'name': 'G4Finder', 'inputs': [fasta], 'outputs': [gplex],
+			'params': dict(motif, seqidIndex=seqidIndex),
+			'run': lambda: G4Finder.main(fasta, gplex, workers=config['workers'], seqidIndex=seqidIndex, **motif)})
+
 	# =========================================================================
 	# Main pipeline modules
 	# =========================================================================
+
+	# Renames blastn's 'Query_#' sequences in the same pass that extracts non-alignments
+	nal = Utils.derivePath(sam, 'gff3')
+	renamedSam = prefix + config['renamedSam'] if config['renamedSam'] else None
+	stages.append({'name': 'NonAlignments', 'inputs': [sam, fasta], 'outputs': [nal] + ([renamedSam] if renamedSam else []),
+		'params': {'seqidIndex': seqidIndex},
+		'run': lambda: NonAlignments.main(sam, config['workers'], fasta, seqidIndex, renamedSam)})
+
+	overlaps = os.path.join(os.path.dirname(annot) or '.', 'overlaps', '')
+	overlapPaths = [Utils.outputPath(overlaps + name) for name in ('genes.gff', 'nals.gff', 'gplexes.gff')]
+	trackPaths = [Utils.outputPath(overlaps + name) for name in ('nals.bedGraph', 'gplexes.bedGraph')] if config['tracks'] else []
+	stages.append({'name': 'GeneOverlap', 'inputs': [annot, gplex, nal], 'outputs': overlapPaths + trackPaths,
+		'params': {'minCov': config['minCov'], 'maxDist': config['maxDist'], 'tracks': config['tracks']},
+		'run': lambda: GeneOverlap.main(annot, gplex, nal, config['minCov'], config['maxDist'], config['workers'], tracks=config['tracks'])})
 	
-	NonAlignments.main(sam)
-	nal = sam[:-3] + 'gff3'
-	
-	GeneOverlap.main(annot, gplex, nal)
-	
+	# Adds sequences to the overlapping entries
+	if config['sequences'] or config['flank'] > 0:
+		def annotate():
+			for path in overlapPaths: Sequences.annotate(path, fasta, None, config['sequences'], config['flank'], seqidIndex)
+		stages.append({'name': 'Sequences', 'inputs': overlapPaths + [fasta],
+			'outputs': [Utils.derivePath(path, 'seq.gff3') for path in overlapPaths],
+			'params': {'sequences': config['sequences'], 'flank': config['flank'], 'seqidIndex': seqidIndex},
+			'run': annotate})
+
 	# =========================================================================
 	# Summary data modules
 	# =========================================================================
-	
-	output1 = prefix + 'analyses/gplex.txt'
-	NearestAnnot.generate(gplex, annot, output1)
-	NearestAnnot.summarize(output1, fasta)
 
-	output2 = prefix + 'analyses/nal.txt'
-	NearestAnnot.generate(gplex, nal, output2)
-	NearestAnnot.summarize(output2, fasta)
-	
+	for name, target in (('gplex', annot), ('nal', nal)):
+		output = prefix + 'analyses/' + name + '.tsv'
+		def analyze(target=target, output=output):
+			NearestAnnot.generate(gplex, target, output, config['workers'])
+			NearestAnnot.summarize(output, fasta, seqidIndex)
+			if config['report']: NearestAnnot.render(output)
+		stages.append({'name': 'NearestAnnot-' + name, 'inputs': [gplex, target, fasta],
+			'outputs': [output, prefix + 'analyses/' + name + '_summary.txt'] + ([prefix + 'analyses/' + name + '.txt'] if config['report'] else []),
+			'params': {'seqidIndex': seqidIndex, 'report': config['report']},
+			'run': analyze})
+
+	return stages
+
+def isUpToDate(stage, stampDir):
+	"""Check whether a stage can be skipped.
+
+	:param stage: a stage generated by buildStages()
+	:param stampDir: directory containing the stamp files of finished stages
+	:return: True if the stage last finished with the same parameters, inputs and outputs
+	"""
+	import os
+	import json
+
+	try:
+		with open(os.path.join(stampDir, stage['name'] + '.json'), 'r') as f: stamp = json.load(f)
+	except (OSError, ValueError):
+		return False
+	return (stamp.get('params') == stage['params']
+		and stamp.get('inputs') == {path: _signature(path) for path in stage['inputs']}
+		and stamp.get('outputs') == {path: _signature(path) for path in stage['outputs']}
+		and all(os.path.exists(path) for path in stage['outputs']))
+
+def writeStamp(stage, stampDir):
+	"""Record that a stage has finished.
+
+	:param stage: a stage generated by buildStages()
+	:param stampDir: directory containing the stamp files of finished stages
+	:return: nothing
+	"""
+	import os
+	import json
+
+	os.makedirs(stampDir, exist_ok=True)
+	stamp = {'params': stage['params'],
+		'inputs': {path: _signature(path) for path in stage['inputs']},
+		'outputs': {path: _signature(path) for path in stage['outputs']}}
+	with open(os.path.join(stampDir, stage['name'] + '.json'), 'w') as f: json.dump(stamp, f, indent='\t')
+
+def _signature(path):
+	"""Summarize the state of a file.
+
+	:param path: path to the file
+	:return: [size, modification time in ns], or None if the file doesn't exist
+	"""
+	import os
+
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	return [stat.st_size, stat.st_mtime_ns]
+
+def loadConfig(configPath):
+	"""Load the settings of a pipeline run from a JSON file.
+
+	:param configPath: path to the JSON-formatted config file
+	:return: a dict of settings (see DEFAULTS)
+	"""
+	import json
+
+	with open(configPath, 'r') as f: config = json.load(f)
+	unknown = set(config) - set(DEFAULTS)
+	if unknown: raise ValueError('Unknown settings in ' + configPath + ': ' + ', '.join(sorted(unknown)))
+	return config
+
 # =============================================================================
 
 if __name__=='__main__':
-	main()
\ No newline at end of file
+	import sys
+	import argparse
+
+	if len(sys.argv) == 1:
+		main()
+	else:
+		parser = argparse.ArgumentParser(description='Run the G4 annotation pipeline, skipping stages that are up to date.')
+		parser.add_argument('--config',
+							help='path to a JSON file of settings; command-line flags override it')
+		parser.add_argument('--prefix',
+							help='path to directory containing all files')
+		parser.add_argument('--fasta',
+							help='filename of genomic FASTA file')
+		parser.add_argument('--annot',
+							help='filename of genomic annotation GFF file')
+		parser.add_argument('--bed',
+							help='filename of QuadBase2 Tetraplex Finder BED file (default=finds G-quadruplexes from the FASTA file)')
+		parser.add_argument('--sam',
+							help='filename of blastn SAM file')
+		parser.add_argument('--renamedSam',
+							help='filename where the SAM file with blastn\'s \'Query_#\' names replaced should be written; may be the SAM file itself')
+		parser.add_argument('--seqidIndex', type=int,
+							help='position of the sequence label within each FASTA header (default=asks the user)')
+		parser.add_argument('--minCov', type=float,
+							help='minimum overlap required of non-aligned region (default=0.5)')
+		parser.add_argument('--maxDist', type=int,
+							help='max number of base pairs separating a gplex and gene (default=0)')
+		parser.add_argument('--minRun', type=int,
+							help='min length of each G-run, if no BED file is given (default=3)')
+		parser.add_argument('--maxRun', type=int,
+							help='max length of each G-run, if no BED file is given (default=7)')
+		parser.add_argument('--minLoop', type=int,
+							help='min length of each loop, if no BED file is given (default=1)')
+		parser.add_argument('--maxLoop', type=int,
+							help='max length of each loop, if no BED file is given (default=7)')
+		parser.add_argument('--sequences', action='store_true', default=None,
+							help='also write the overlapping genes, non-alignments and gplexes with their sequences')
+		parser.add_argument('--flank', type=int,
+							help='size of the flanking windows to write with the overlapping entries (default=0)')
+		parser.add_argument('--tracks', action='store_true', default=None,
+							help='also write the coverage of non-alignments and gplexes as bedGraph files')
+		parser.add_argument('--report', action='store_true', default=None,
+							help='also render the analysis data files as fixed-width text reports')
+		parser.add_argument('--workers', type=int,
+							help='number of processes that sequences are shared out to; 0 uses every CPU (default=1)')
+		parser.add_argument('--compress', action='store_true', default=None,
+							help='write derived GFF files gzip-compressed')
+		parser.add_argument('--profile', action='store_true', default=None,
+							help='write cProfile stats of each stage to <prefix>/profiles/')
+		parser.add_argument('--tracemalloc', action='store_true', default=None,
+							help='trace the peak Python memory allocations of each stage')
+		parser.add_argument('--force', action='store_true',
+							help='run every stage, even if it is up to date')
+		args = parser.parse_args()
+
+		config = loadConfig(args.config) if args.config else {}
+		for key in DEFAULTS:
+			if getattr(args, key) is not None: config[key] = getattr(args, key)
+		run(config, args.force)
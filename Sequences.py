@@ -0,0 +1,145 @@
+# =============================================================================
+# bmle
+# G4Pipeline: Sequences.py
+# Random access to the sequences of a FASTA file, through its index and a memory map
+# =============================================================================
+
+import Instrument
+
+_COMPLEMENT = bytes.maketrans(b'ACGTRYKMBDHVNacgtrykmbdhvn', b'TGCAYRMKVHDBNtgcayrmkvhdbn')
+
+class Genome:
+	"""A FASTA file that can be sliced by sequence and position without reading it into memory.
+
+	Positions are translated to byte offsets using the FASTA index (see Utils.loadFastaIndex()),
+	so every sequence of the file must have lines of a regular length.
+	"""
+
+	def __init__(self, fastaPath, seqidIndex=None):
+		"""Memory-map a FASTA file.
+
+		:param fastaPath: path to the uncompressed FASTA-formatted genomic sequence file
+		:param seqidIndex: position of the sequence label within each FASTA header (default=asks the user)
+		"""
+		import mmap
+		from Utils import loadFastaIndex, seqLabels, isCompressed
+
+		if isCompressed(fastaPath): raise ValueError(fastaPath + ' is compressed and can\'t be randomly accessed; please decompress it first!')
+		self.index = {}
+		for label, entry in zip(seqLabels(fastaPath, seqidIndex), loadFastaIndex(fastaPath)):
+			if entry[3] == 0 and entry[1] > 0:
+				raise ValueError('Sequence ' + entry[0] + ' of ' + fastaPath + ' has irregular line lengths; please reformat it (e.g. with samtools faidx)!')
+			self.index[label] = entry[1:]
+		self._file = open(fastaPath, 'rb')
+		self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		"""Unmap the FASTA file.
+
+		:return: nothing
+		"""
+		self._mm.close()
+		self._file.close()
+
+	def length(self, seqid):
+		"""Get the length of a sequence.
+
+		:param seqid: the sequence label
+		:return: number of residues in the sequence
+		"""
+		return self.index[seqid][0]
+
+	def fetch(self, seqid, start, end, strand='+'):
+		"""Get part of a sequence.
+
+		:param seqid: the sequence label
+		:param start: start position (1-based, inclusive); clipped to the sequence
+		:param end: end position (1-based, inclusive); clipped to the sequence
+		:param strand: '-' for the reverse complement, otherwise the sense strand (default='+')
+		:return: the residues as a string
+		"""
+		length, offset, lineBases, lineWidth = self.index[seqid]
+		start = max(start, 1) - 1
+		end = min(end, length)
+		if end <= start: return ''
+		first = offset + start // lineBases * lineWidth + start % lineBases
+		last = offset + (end-1) // lineBases * lineWidth + (end-1) % lineBases
+		residues = self._mm[first:last+1].translate(None, b'\r\n')
+		if strand == '-': residues = residues.translate(_COMPLEMENT)[::-1]
+		return residues.decode()
+
+@Instrument.timed('Sequences')
+def annotate(gffPath, fastaPath, outPath=None, sequence=True, flank=0, seqidIndex=None):
+	"""Write a copy of a GFF file whose entries also hold their sequences and/or flanking sequences.
+
+	Sequences are given on the strand of each entry, as the attributes 'seq', and
+	'upstream' and 'downstream' for the flanking windows.
+
+	:param gffPath: path to the GFF-formatted file
+	:param fastaPath: path to the uncompressed FASTA-formatted genomic sequence file
+	:param outPath: path where the new GFF file should be written (default=next to gffPath, ending in '.seq.gff3')
+	:param sequence: whether to add the sequence of each entry (default=True)
+	:param flank: size of the flanking windows to add on each side of each entry; 0 adds none (default=0)
+	:param seqidIndex: position of the sequence label within each FASTA header (default=asks the user)
+	:return: writes a GFF file of the entries of gffPath with their sequences
+	"""
+	from Utils import openFile, derivePath
+	print('\nAdding sequences to ' + gffPath + '...')
+
+	if outPath is None: outPath = derivePath(gffPath, 'seq.gff3')
+	count = 0
+	with Genome(fastaPath, seqidIndex) as genome, openFile(gffPath, 'r') as gffFile, openFile(outPath, 'w') as outFile:
+		for line in Instrument.progress(gffFile, 'Entries'):
+			if line.startswith('#') or not line.strip():
+				outFile.write(line)
+				continue
+			temp = line.rstrip('\n').split('\t')
+			seqid, start, end, strand = temp[0], int(temp[3]), int(temp[4]), temp[6]
+			if seqid not in genome.index:
+				outFile.write(line)
+				continue
+
+			# Upstream lies before the start of an entry on the sense strand, and after its end on the antisense strand
+			toAdd = []
+			if sequence: toAdd.append('seq=' + genome.fetch(seqid, start, end, strand))
+			if flank > 0:
+				before = genome.fetch(seqid, start-flank, start-1, strand)
+				after = genome.fetch(seqid, end+1, end+flank, strand)
+				if strand == '-': before, after = after, before
+				toAdd.append('upstream=' + before)
+				toAdd.append('downstream=' + after)
+			attributes = temp[8] if len(temp) > 8 else ''
+			temp[8:] = [attributes + ('' if not attributes or attributes.endswith(';') else ';') + ';'.join(toAdd)]
+			outFile.write('\t'.join(temp) + '\n')
+			count += 1
+	Instrument.count(count)
+
+	print('Finished writing to ' + outPath + '\nFinished!\n')
+
+# =============================================================================
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Add the sequences and/or flanking sequences of the entries of a GFF file as attributes.')
+	parser.add_argument('gffPath',
+						help='path to the GFF-formatted file')
+	parser.add_argument('fastaPath',
+						help='path to the uncompressed FASTA-formatted genomic sequence file')
+	parser.add_argument('--outPath',
+						help='path where the new GFF file should be written (default=next to gffPath, ending in \'.seq.gff3\')')
+	parser.add_argument('--flank', type=int, action='store', default=0,
+						help='size of the flanking windows to add on each side of each entry (default=0)')
+	parser.add_argument('--noSequence', action='store_true',
+						help='don\'t add the sequence of each entry itself')
+	parser.add_argument('--seqidIndex', type=int, action='store', default=None,
+						help='position of the sequence label within each FASTA header (default=asks the user)')
+	args = parser.parse_args()
+
+	annotate(args.gffPath, args.fastaPath, args.outPath, not args.noSequence, args.flank, args.seqidIndex)
@@ -0,0 +1,347 @@
+# =============================================================================
+# bmle
+# G4Pipeline: Server.py
+# Answers nearest, overlap and window queries on the annotation, gplex and
+# non-alignment files of a run from indexes held in memory, over localhost
+# HTTP or a Unix socket, reloading the files when they change
+# =============================================================================
+
+import json
+from http.server import BaseHTTPRequestHandler
+
+class Indexes:
+	"""The annotation, gplex and non-alignment files of a run, indexed by sequence and position."""
+
+	def __init__(self, paths):
+		"""Load and index every file.
+
+		:param paths: a dict mapping each source ('annot', 'gplex' and/or 'nal') to the path of its GFF file
+		"""
+		import time
+		from Utils import loadTable
+		from Intervals import buildIndex, buildEndpointIndex, buildCoverage
+		from NearestAnnot import NEAREST_TYPES
+
+		self.paths = dict(paths)
+		self.stamps = {source: _stamp(path) for source, path in self.paths.items()}
+		self.tables = {}
+		self.overlapIndexes = {}
+		self.nearestIndexes = {}
+		self.coverages = {}
+		for source, path in self.paths.items():
+			table = loadTable(path)[2]
+			self.tables[source] = table
+			self.overlapIndexes[source] = buildIndex(table.intervals())
+			self.nearestIndexes[source] = buildEndpointIndex(table.intervals(types=NEAREST_TYPES if source == 'annot' else None))
+			self.coverages[source] = buildCoverage(table.intervals())
+		self.loaded = time.time()
+
+	def changed(self):
+		"""Check whether any file was modified, replaced or removed since it was loaded.
+
+		:return: True if any file changed
+		"""
+		return any(_stamp(path) != self.stamps[source] for source, path in self.paths.items())
+
+	def status(self):
+		"""Describe the loaded files.
+
+		:return: a dict of the path and number of entries of each source, and when they were loaded
+		"""
+		return {'files': {source: {'path': path, 'entries': len(self.tables[source])} for source, path in self.paths.items()},
+			'loaded': self.loaded}
+
+	def answer(self, query):
+		"""Answer a single query.
+
+		Every query is a dict with an 'op', a 'seqid' and a region given by 'start' and 'end'
+		(1-based, inclusive; 'end' defaults to 'start'):
+			'overlap': the entries of 'source' (default='gplex') that overlap the region
+			'window': the entries of 'source' (default='annot') within 'flank' (default=0) base pairs of the region
+			'nearest': the entry of 'source' (default='annot') with an endpoint closest to the region, as in NearestAnnot.py
+			'coverage': the number and fraction of the region's bases covered by entries of 'source' (default='nal')
+			'genes': the genes in the region that overlap non-alignments and gplexes, as in GeneOverlap.py,
+				with 'minCov' (default=0.5) and 'maxDist' (default=0)
+
+		:param query: the query
+		:return: a dict with the query's 'results', or its 'error'
+		"""
+		try:
+			op = query['op']
+			seqid = query['seqid']
+			start = int(query['start'])
+			end = int(query.get('end', start))
+			if op == 'overlap':
+				return {'results': self.overlap(query.get('source', 'gplex'), seqid, start, end)}
+			elif op == 'window':
+				return {'results': self.window(query.get('source', 'annot'), seqid, start, end, int(query.get('flank', 0)))}
+			elif op == 'nearest':
+				return {'results': self.nearest(query.get('source', 'annot'), seqid, start, end)}
+			elif op == 'coverage':
+				return {'results': self.coverage(query.get('source', 'nal'), seqid, start, end)}
+			elif op == 'genes':
+				return {'results': self.genes(seqid, start, end, float(query.get('minCov', 0.5)), int(query.get('maxDist', 0)))}
+			return {'error': 'Unknown op: ' + str(op)}
+		except KeyError as e:
+			return {'error': 'Missing or unknown ' + str(e)}
+		except (TypeError, ValueError, AttributeError) as e:
+			return {'error': str(e)}
+
+	def overlap(self, source, seqid, start, end):
+		"""Find the entries of a file that overlap a region.
+
+		:param source: 'annot', 'gplex' or 'nal'
+		:param seqid: the sequence to search
+		:param start: start position of the region
+		:param end: end position of the region
+		:return: a list of entries (see entry())
+		"""
+		from Intervals import overlapping
+
+		table = self.tables[source]
+		return [self.entry(table, i) for i in overlapping(self.overlapIndexes[source], seqid, start, end)]
+
+	def window(self, source, seqid, start, end, flank):
+		"""Find the entries of a file within a number of base pairs of a region.
+
+		:param source: 'annot', 'gplex' or 'nal'
+		:param seqid: the sequence to search
+		:param start: start position of the region
+		:param end: end position of the region
+		:param flank: max number of base pairs separating an entry and the region
+		:return: a list of entries (see entry()), each with its 'distance' to the region (0 if they overlap)
+		"""
+		from Intervals import overlapping
+
+		table = self.tables[source]
+		results = []
+		for i in overlapping(self.overlapIndexes[source], seqid, start-flank, end+flank):
+			result = self.entry(table, i)
+			result['distance'] = max(0, table.starts[i] - end, start - table.ends[i])
+			results.append(result)
+		return results
+
+	def nearest(self, source, seqid, start, end):
+		"""Find the entry of a file with an endpoint closest to either endpoint of a region.
+
+		:param source: 'annot', 'gplex' or 'nal'
+		:param seqid: the sequence to search
+		:param start: start position of the region
+		:param end: end position of the region
+		:return: a list holding the entry (see entry()), with its closest 'endpoints', signed 'distance' and the 'location'
+			of the region relative to it; empty if the sequence has no entries
+		"""
+		from Intervals import nearest
+		from NearestAnnot import relativeLocation
+
+		table = self.tables[source]
+		i = nearest(self.nearestIndexes[source], seqid, start, end)
+		if i is None: return []
+		result = self.entry(table, i)
+		result['endpoints'], result['distance'], result['location'] = relativeLocation(start, end, table.starts[i], table.ends[i])
+		return [result]
+
+	def coverage(self, source, seqid, start, end):
+		"""Measure how much of a region is covered by the entries of a file.
+
+		:param source: 'annot', 'gplex' or 'nal'
+		:param seqid: the sequence of the region
+		:param start: start position of the region
+		:param end: end position of the region
+		:return: a dict of the number of 'bases' covered by at least one entry, and the 'fraction' of the region they make up
+		"""
+		from Intervals import coveredBases
+
+		bases = coveredBases(self.coverages[source], seqid, start, end)
+		return {'bases': bases, 'fraction': bases / (end-start+1) if end >= start else 0}
+
+	def genes(self, seqid, start, end, minCov, maxDist):
+		"""Find the genes in a region that overlap at least one gplex and at least one non-alignment.
+
+		:param seqid: the sequence to search
+		:param start: start position of the region
+		:param end: end position of the region
+		:param minCov: minimum overlap required of non-aligned region
+		:param maxDist: max number of base pairs separating a gplex and gene
+		:return: a list of genes (see entry()), each with its 'coverage' and lists of its 'nals' and 'gplexes'
+		"""
+		from Intervals import overlapping
+		from GeneOverlap import geneCoverage, nearbyGplexes
+
+		if 'nal' not in self.tables: raise ValueError('Gene queries need a non-alignment file!')
+		annot = self.tables['annot']
+		nals = self.tables['nal']
+		gplexes = self.tables['gplex']
+		results = []
+		for i in overlapping(self.overlapIndexes['annot'], seqid, start, end):
+			if annot.field(i, 2) != 'gene': continue
+			coverage = geneCoverage(self.coverages['nal'], seqid, annot.starts[i], annot.ends[i])
+			if coverage <= minCov: continue
+			geneGplexes = nearbyGplexes(self.overlapIndexes['gplex'], gplexes, seqid, annot.starts[i], annot.ends[i], maxDist)
+			if geneGplexes:
+				result = self.entry(annot, i)
+				result['coverage'] = coverage
+				result['nals'] = [self.entry(nals, j) for j in overlapping(self.overlapIndexes['nal'], seqid, annot.starts[i], annot.ends[i])]
+				result['gplexes'] = [self.entry(gplexes, j) for j in geneGplexes]
+				results.append(result)
+		return results
+
+	@staticmethod
+	def entry(table, i):
+		"""Describe an entry of a file.
+
+		:param table: the GFFTable holding the entry
+		:param i: index of the entry
+		:return: a dict of its 'seqid', 'source', 'type', 'start', 'end', 'score', 'strand', 'phase' and 'attributes'
+		"""
+		return {'seqid': table.field(i, 0), 'source': table.field(i, 1), 'type': table.field(i, 2),
+			'start': table.starts[i], 'end': table.ends[i], 'score': table.field(i, 5), 'strand': table.field(i, 6),
+			'phase': table.field(i, 7), 'attributes': table.rawAttributes[i].rstrip('\n')}
+
+def main(annotPath, gplexPath, nalPath=None, host='127.0.0.1', port=8642, socketPath=None, poll=2):
+	"""Serve queries on the files of a run until interrupted.
+
+	Queries are POSTed to '/query' as a JSON object (see Indexes.answer()), or a list of them,
+	which is answered with a list in the same order; '/status' describes the loaded files. The
+	files are checked every 'poll' seconds and reloaded in the background when they change,
+	while queries keep being answered from the previous indexes.
+
+	:param annotPath: path to the GFF3-formatted annotation file
+	:param gplexPath: path to the GFF3-formatted gplex file
+	:param nalPath: path to the GFF3-formatted non-alignment file; needed for 'genes' queries (default=None)
+	:param host: address to listen on (default=127.0.0.1, i.e. only this machine)
+	:param port: port to listen on (default=8642)
+	:param socketPath: if given, listens on this Unix socket instead of host and port
+	:param poll: seconds between checks for changed files (default=2)
+	:return: nothing
+	"""
+	import os
+	import threading
+	import socketserver
+	from http.server import ThreadingHTTPServer
+
+	paths = {'annot': annotPath, 'gplex': gplexPath}
+	if nalPath is not None: paths['nal'] = nalPath
+	print('\nLoading files...')
+	indexes = Indexes(paths)
+
+	if socketPath is not None:
+		if os.path.exists(socketPath): os.remove(socketPath)
+		server = socketserver.ThreadingUnixStreamServer(socketPath, _Handler)
+		address = 'unix:' + socketPath
+	else:
+		server = ThreadingHTTPServer((host, port), _Handler)
+		address = 'http://' + host + ':' + str(server.server_address[1]) + '/'
+	server.daemon_threads = True
+	server.indexes = indexes
+	threading.Thread(target=_watch, args=(server, poll), daemon=True).start()
+
+	print('Serving queries on ' + address + ' (press Ctrl+C to stop)...')
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if socketPath is not None and os.path.exists(socketPath): os.remove(socketPath)
+	print('Finished!\n')
+
+def _watch(server, poll):
+	"""Reload the files of a server whenever they change.
+
+	:param server: the server, whose 'indexes' are replaced
+	:param poll: seconds between checks for changed files
+	:return: nothing; runs until the process exits
+	"""
+	import time
+
+	while True:
+		time.sleep(poll)
+		indexes = server.indexes
+		if not indexes.changed(): continue
+		try:
+			server.indexes = Indexes(indexes.paths)
+			print('Reloaded ' + ', '.join(indexes.paths.values()), flush=True)
+		except Exception as e:		# e.g. a file that is still being written; tried again at the next check
+			print('Failed to reload files: ' + repr(e), flush=True)
+
+def _stamp(path):
+	"""Identify the current version of a file.
+
+	:param path: path to the file
+	:return: a tuple of (size, modification time), or None if the file doesn't exist
+	"""
+	import os
+
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	return (stat.st_size, stat.st_mtime_ns)
+
+class _Handler(BaseHTTPRequestHandler):
+	"""Answers the requests of a single connection, from the indexes of its server."""
+	protocol_version = 'HTTP/1.1'		# keeps connections open between queries
+
+	def setup(self):
+		import socket
+
+		# Headers and body are sent separately, which Nagle's algorithm would hold back until acknowledged
+		if self.request.family in (socket.AF_INET, socket.AF_INET6): self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+		super().setup()
+
+	def do_GET(self):
+		if self.path.rstrip('/') == '/status': self._reply(200, self.server.indexes.status())
+		else: self._reply(404, {'error': 'Unknown path: ' + self.path})
+
+	def do_POST(self):
+		if self.path.rstrip('/') != '/query':
+			self._reply(404, {'error': 'Unknown path: ' + self.path})
+			return
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+		except ValueError as e:
+			self._reply(400, {'error': 'Invalid JSON: ' + str(e)})
+			return
+		indexes = self.server.indexes		# the same indexes answer every query of a batch
+		if isinstance(request, list): self._reply(200, [indexes.answer(query) for query in request])
+		elif isinstance(request, dict): self._reply(200, indexes.answer(request))
+		else: self._reply(400, {'error': 'A query must be an object, or a list of objects'})
+
+	def _reply(self, code, body):
+		data = json.dumps(body).encode()
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def address_string(self):
+		return self.client_address[0] if self.client_address else 'unix'
+
+	def log_message(self, format, *args):
+		pass		# one line per query would flood the terminal
+
+# =============================================================================
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Answer nearest, overlap, window and gene queries on the files of a run, from indexes held in memory.')
+	parser.add_argument('annotPath',
+						help='path to the GFF-formatted annotation file')
+	parser.add_argument('gplexPath',
+						help='path to the GFF-formatted gplex file')
+	parser.add_argument('nalPath', nargs='?', default=None,
+						help='path to the GFF-formatted non-alignment file; needed for gene queries')
+	parser.add_argument('--host', action='store', default='127.0.0.1',
+						help='address to listen on (default=127.0.0.1)')
+	parser.add_argument('--port', type=int, action='store', default=8642,
+						help='port to listen on (default=8642)')
+	parser.add_argument('--socket', action='store', default=None,
+						help='listen on this Unix socket instead of host and port')
+	parser.add_argument('--poll', type=float, action='store', default=2,
+						help='seconds between checks for changed files (default=2)')
+	args = parser.parse_args()
+
+	main(args.annotPath, args.gplexPath, args.nalPath, args.host, args.port, args.socket, args.poll)
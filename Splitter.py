@@ -4,61 +4,201 @@
 # Splits FASTA files into smaller-sized chunks to feed into applications that have limited file sizes
 # =============================================================================
 
-def main(fastaPath, maxSize):
-	"""Split a FASTA file into multiple files of a specified size.
-	
+import Instrument
+
+@Instrument.timed('Splitter')
+def main(fastaPath, maxSize=None, chunks=None, workers=1, balance='bytes'):
+	"""Split a FASTA file into multiple files of a specified size, or into a specified number of files.
+
+	Sequences are copied byte-for-byte from fastaPath and shared out so that the files are
+	as even as possible; within each file, sequences keep the order they have in fastaPath.
+	Compressed files are streamed once, one split file at a time, so each of their split
+	files holds a run of consecutive sequences.
+
 	:param fastaPath: path to the FASTA-formatted genome file
 	:param maxSize: max size (in MB) of each split file
+	:param chunks: number of split files; takes precedence over maxSize
+	:param workers: number of files written at the same time; 0 uses every CPU (default=1)
+	:param balance: what to even out between files: 'bytes', or 'residues' (default='bytes')
 	:return: writes a directory of files that represent pieces of fastaPath
 	"""
 	import os
-	from Bio import SeqIO
+	import mmap
+	from Utils import loadFastaIndex, isCompressed, outputPath
 	print('Splitting file...')
-	
-	actualMaxSize = float(maxSize)*1000000		# convert maxSize to bytes
+
+	if maxSize is None and chunks is None: raise ValueError('Either a max file size or a number of files must be specified!')
 	outPath = os.path.dirname(fastaPath) + '/splitFiles/'
 	os.makedirs(outPath, exist_ok=True)
-	
-	# file path generator
-	def fileGen(outStr):
-		i = 0
-		while True:
-			yield outStr + str(i) + '.fasta'
-			i += 1
-	
-	lenAcc = 0
-	recordAcc = []
-	fGen = fileGen(outPath)
-	
-	for rec in SeqIO.parse(fastaPath, 'fasta'):
-		seqLen = len(rec.seq)
-		seqLen += round(seqLen/60)	# Includes line breaks in length calculation
-		
-		if seqLen > actualMaxSize:
-			raise ValueError("Sequence " + rec.id + " is larger than the specified max file size (" + str(maxSize) + "); please specify a larger size!")
-		elif (lenAcc + seqLen) > actualMaxSize:
-			SeqIO.write(recordAcc, next(fGen), 'fasta')
-			lenAcc = seqLen
-			recordAcc = [rec]
+
+	# Finds the byte range of each sequence, from the start of its header to the start of the next one
+	entries = loadFastaIndex(fastaPath)
+	if not entries:
+		print('No sequences in ' + fastaPath + '!')
+		return
+	compressed = isCompressed(fastaPath)
+	if compressed:
+		ranges = None
+		sizes = [entry[1] + entry[1] // 60 + len(entry[0]) + 2 for entry in entries]	# estimated, as offsets only apply to the decompressed stream
+	else:
+		with open(fastaPath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			starts = [mm.rfind(b'\n', 0, entry[2]-1) + 1 for entry in entries]
+			ranges = list(zip(starts, starts[1:] + [len(mm)]))
+		sizes = [end-start for start, end in ranges]
+	weights = [entry[1] for entry in entries] if balance == 'residues' else sizes
+
+	# Shares sequences out between files
+	if chunks is None:
+		actualMaxSize = float(maxSize)*1000000		# convert maxSize to bytes
+		for entry, size in zip(entries, sizes):
+			if size > actualMaxSize:
+				raise ValueError("Sequence " + entry[0] + " is larger than the specified max file size (" + str(maxSize) + "); please specify a larger size!")
+		bins = planChunks(sizes, capacity=actualMaxSize, contiguous=compressed)
+		balanced = planChunks(weights, count=len(bins), contiguous=compressed)
+		if all(sum(sizes[i] for i in b) <= actualMaxSize for b in balanced): bins = balanced
+	else:
+		bins = planChunks(weights, count=min(int(chunks), len(entries)), contiguous=compressed)
+	chunkPaths = [outputPath(outPath + str(i) + '.fasta') for i in range(len(bins))]
+
+	# Writes every file
+	if compressed:
+		_streamChunks(fastaPath, bins, chunkPaths)
+	else:
+		from concurrent.futures import ThreadPoolExecutor
+		if workers is not None and workers <= 0: workers = os.cpu_count()
+		tasks = [(fastaPath, [ranges[i] for i in b], path) for b, path in zip(bins, chunkPaths)]
+		with ThreadPoolExecutor(max_workers=max(1, min(workers or 1, len(tasks)))) as pool:
+			for _ in Instrument.progress(pool.map(_copyRanges, tasks), 'Files', total=len(tasks)): pass
+	Instrument.count(len(entries))
+
+	print('Finished writing ' + str(len(bins)) + ' files to ' + outPath + '\nFinished!')
+
+def planChunks(weights, capacity=None, count=None, contiguous=False):
+	"""Share items out between bins.
+
+	Items are taken heaviest first, and each goes to the lightest bin (kept in a heap, so
+	planning takes O(n log bins) time). With a count, this evens out the bins; with a capacity,
+	a new bin is opened whenever an item doesn't fit in the lightest one, as it fits in no other.
+
+	If contiguous, every bin is instead a run of consecutive items, so the bins can be written
+	one after another in a single pass: with a capacity, each bin is filled in order until the
+	next item doesn't fit, and with a count, items are cut into runs of roughly equal weight.
+
+	:param weights: the weight of each item
+	:param capacity: max total weight of each bin
+	:param count: number of bins
+	:param contiguous: whether every bin must be a run of consecutive items (default=False)
+	:return: a list of bins, each a sorted list of item indices; bins are ordered by their first item
+	"""
+	import heapq
+
+	if contiguous:
+		bins = [[]]
+		if count is not None:
+			total = sum(weights) or 1
+			done = 0
+			last = 0
+			for i, weight in enumerate(weights):
+				b = min(count-1, int((done + weight/2) * count / total))	# the run holding the middle of the item
+				if b != last and bins[-1]: bins.append([])
+				bins[-1].append(i)
+				done += weight
+				last = b
 		else:
-			lenAcc += seqLen
-			recordAcc.append(rec)
-	SeqIO.write(recordAcc, next(fGen), 'fasta')
-	
-	print('Finished!')
+			load = 0
+			for i, weight in enumerate(weights):
+				if bins[-1] and load + weight > capacity:
+					bins.append([])
+					load = 0
+				bins[-1].append(i)
+				load += weight
+		return [b for b in bins if b]
+
+	order = sorted(range(len(weights)), key=lambda i: -weights[i])
+	if count is not None:
+		bins = [[] for _ in range(count)]
+		heap = [(0, b) for b in range(count)]
+	else:
+		bins = []
+		heap = []
+	for i in order:
+		if heap and (count is not None or heap[0][0] + weights[i] <= capacity):
+			load, b = heapq.heappop(heap)
+		else:
+			load, b = 0, len(bins)
+			bins.append([])
+		bins[b].append(i)
+		heapq.heappush(heap, (load + weights[i], b))
+	return sorted((sorted(b) for b in bins if b), key=lambda b: b[0])
+
+def _copyRanges(task):
+	"""Copy byte ranges of a file into a new file.
+
+	:param task: a tuple of (path to the source file, list of (start, end) byte ranges, path to the new file)
+	:return: nothing
+	"""
+	from Utils import openFile
+
+	sourcePath, ranges, chunkPath = task
+	with open(sourcePath, 'rb') as source, openFile(chunkPath, 'wb') as chunk:
+		for start, end in ranges:
+			source.seek(start)
+			remaining = end - start
+			block = b''
+			while remaining > 0:
+				block = source.read(min(remaining, 1 << 20))
+				if not block: break
+				chunk.write(block)
+				remaining -= len(block)
+			if block and not block.endswith(b'\n'): chunk.write(b'\n')	# last sequence of a file without a trailing line break
+
+def _streamChunks(fastaPath, bins, chunkPaths):
+	"""Write split files by streaming through a FASTA file whose byte offsets can't be used (i.e. a compressed one).
+
+	Only one split file is open at a time, so the bins must be runs of consecutive sequences.
+
+	:param fastaPath: path to the FASTA-formatted genome file
+	:param bins: a list of bins, each a run of consecutive sequence indices, as generated by planChunks(contiguous=True)
+	:param chunkPaths: path to the split file of each bin
+	:return: nothing
+	"""
+	from Utils import openFile
+
+	ends = [b[-1] for b in bins]	# index of the last sequence of each file
+	b = 0
+	i = -1
+	current = openFile(chunkPaths[0], 'wb')
+	try:
+		with openFile(fastaPath, 'rb') as fastaFile:
+			for line in fastaFile:
+				if line.startswith(b'>'):
+					i += 1
+					if i > ends[b]:
+						current.close()
+						b += 1
+						current = openFile(chunkPaths[b], 'wb')
+				if i >= 0: current.write(line if line.endswith(b'\n') else line + b'\n')
+	finally:
+		current.close()
 
 # =============================================================================
 
 if __name__ == '__main__':
 	import argparse
-	
+
 	parser = argparse.ArgumentParser(
-		description='Splits a FASTA file into multiple files of a specified size.')
+		description='Splits a FASTA file into multiple files of a specified size, or into a specified number of files.')
 	parser.add_argument('fastaPath',
 						help='path to the FASTA-formatted genome file')
-	parser.add_argument('size', type=float,
+	parser.add_argument('size', type=float, nargs='?',
 						help='max size (in MB) of each split file')
+	parser.add_argument('--chunks', type=int, action='store', default=None,
+						help='number of split files; takes precedence over size')
+	parser.add_argument('--workers', type=int, action='store', default=1,
+						help='number of files written at the same time; 0 uses every CPU (default=1)')
+	parser.add_argument('--balance', choices=['bytes', 'residues'], default='bytes',
+						help='what to even out between split files (default=bytes)')
 	args = parser.parse_args()
 
-	main(args.fastaPath, args.size)
-	
\ No newline at end of file
+	if args.size is None and args.chunks is None: parser.error('either size or --chunks must be specified')
+	main(args.fastaPath, args.size, args.chunks, args.workers, args.balance)
@@ -4,23 +4,179 @@
 # Utilities for manipulating GFF, FASTA, and SAM files
 # =============================================================================
 
-def load(filePath):
-	"""Load the contents of a GFF file.
+import Instrument
+
+# Settings shared by every module; 'compress' makes derived GFF outputs gzip-compressed,
+# 'sortMemory' is the approx. number of MB of entries writeFile() sorts in memory before spilling to disk
+settings = {'compress': False, 'sortMemory': 256}
+
+def openFile(filePath, mode='r', compress=None):
+	"""Open a file, transparently streaming gzip/bgzip-compressed files.
+	
+	Files are read as gzip if they start with the gzip magic number, and written as gzip
+	if filePath ends with '.gz'. Compressed streams are read and written in large blocks.
+	
+	:param filePath: path to the file
+	:param mode: 'r', 'w' or 'a', optionally with 'b' for binary mode (default='r')
+	:param compress: whether a file opened for writing is compressed (default=if filePath ends with '.gz')
+	:return: a file object
+	"""
+	import io
+	import gzip
+	
+	blockSize = 1 << 20
+	if 'r' in mode:
+		with open(filePath, 'rb') as f: compressed = f.read(2) == b'\x1f\x8b'
+		if not compressed: return open(filePath, mode, buffering=blockSize)
+		stream = io.BufferedReader(gzip.GzipFile(filePath, 'rb'), buffer_size=blockSize)
+	elif compress or (compress is None and filePath.endswith('.gz')):
+		stream = io.BufferedWriter(gzip.GzipFile(filePath, mode.replace('b', '') + 'b', compresslevel=6), buffer_size=blockSize)
+	else:
+		return open(filePath, mode, buffering=blockSize)
+	return stream if 'b' in mode else io.TextIOWrapper(stream)
+
+def isCompressed(filePath):
+	"""Check whether a file is gzip/bgzip-compressed.
+	
+	:param filePath: path to the file
+	:return: True if the file starts with the gzip magic number
+	"""
+	with open(filePath, 'rb') as f: return f.read(2) == b'\x1f\x8b'
+
+def outputPath(filePath):
+	"""Add a '.gz' suffix to the path of an output file if outputs should be compressed.
+	
+	:param filePath: path to the output file
+	:return: the path that the output should actually be written to
+	"""
+	if settings['compress'] and not filePath.endswith('.gz'): return filePath + '.gz'
+	return filePath
+
+def derivePath(filePath, ext):
+	"""Build the path of an output file from the path of its input, e.g. 'x.bed.gz' -> 'x.gff3'.
+	
+	:param filePath: path to the input file
+	:param ext: extension of the output file, without the leading '.'
+	:return: the path that the output should be written to (see outputPath())
+	"""
+	import os
+	
+	if filePath.endswith('.gz'): filePath = filePath[:-3]
+	return outputPath(os.path.splitext(filePath)[0] + '.' + ext)
+
+class SeqidOrder:
+	"""The natural order of seqids (e.g. chr2 < chr10), as integer ranks.
+	
+	Ranks are built once, so that entries can be sorted on cheap tuples of integers instead
+	of natural-sort keys. Streams whose seqids aren't all known up front use key() instead,
+	whose keys never change as further seqids are seen.
+	"""
+	
+	def __init__(self, seqids=()):
+		"""Rank a set of seqids.
+		
+		:param seqids: an iterable of seqids
+		"""
+		self.ranks = {}
+		self.keys = {}
+		self.add(seqids)
+	
+	@classmethod
+	def fromSeqRegs(cls, seqregs):
+		"""Rank the seqids of the '##sequence-region' headers of a GFF file.
+		
+		:param seqregs: an iterable of header lines; lines that aren't sequence-regions are ignored
+		:return: a SeqidOrder
+		"""
+		return cls(line.split()[1] for line in seqregs if line.startswith('##sequence-region'))
+	
+	def add(self, seqids):
+		"""Rank any new seqids.
+		
+		:param seqids: an iterable of seqids
+		:return: nothing
+		"""
+		from natsort import natsorted
+		
+		new = set(seqid for seqid in seqids if seqid not in self.ranks)
+		if new: self.ranks = {seqid: rank for rank, seqid in enumerate(natsorted(list(self.ranks) + list(new)))}
+	
+	def key(self, seqid):
+		"""Get the natural-sort key of a seqid, computed once per seqid.
+		
+		Unlike ranks, keys don't depend on which other seqids were seen, so entries sorted
+		with them stay sorted however many new seqids turn up later.
+		
+		:param seqid: a seqid
+		:return: a key that orders seqid naturally against the key of any other seqid
+		"""
+		key = self.keys.get(seqid)
+		if key is None:
+			from natsort import natsort_keygen
+			
+			key = self.keys[seqid] = natsort_keygen()(seqid)
+		return key
+	
+	def sort(self, items, key):
+		"""Sort a list of items by seqid and any further fields, unless it is already sorted.
+		
+		:param items: a list of items
+		:param key: a function mapping an item to a tuple of (seqid, ...)
+		:return: items (sorted in place; the sort is stable)
+		"""
+		keys = [key(item) for item in items]
+		self.add(k[0] for k in keys)
+		ranks = self.ranks
+		keys = [(ranks[k[0]],) + tuple(k[1:]) for k in keys]
+		if not isSorted(keys):
+			order = sorted(range(len(items)), key=keys.__getitem__)
+			items[:] = [items[i] for i in order]
+		return items
+
+def isSorted(keys):
+	"""Check whether a sequence of keys is in ascending order, in a single pass.
+	
+	:param keys: a list of comparable keys
+	:return: True if no key is smaller than the one before it
+	"""
+	from itertools import islice
+	return all(a <= b for a, b in zip(keys, islice(keys, 1, None)))
+
+def load(filePath, types=None, seqids=None, region=None):
+	"""Load the contents of a GFF file, reusing a cached copy if the file hasn't changed.
+
+	Filters are applied while the file is read, so entries that don't pass them are never parsed,
+	stored or sorted; headers and sequence-regions are always loaded.
 
 	:param filePath: the absolute path to the GFF file
+	:param types: if given, only entries whose type is in types are loaded (default=None)
+	:param seqids: if given, only entries on these sequences are loaded (default=None)
+	:param region: if given, a (seqid, start, end) tuple; only entries that overlap it are loaded (default=None)
+	:return: a list of lists representing the contents of the GFF file
+	"""
+	from Cache import cached
+	return cached(_load, filePath, *_filterArgs(types, seqids, region))
+
+def _load(filePath, types=None, seqids=None, region=None):
+	"""Parse and sort the contents of a GFF file.
+
+	:param filePath: the absolute path to the GFF file
+	:param types: the types of entries to load, or None for every type (see load())
+	:param seqids: the sequences to load entries of, or None for every sequence
+	:param region: a (seqid, start, end) tuple that loaded entries must overlap, or None
 	:return: a list of lists representing the contents of the GFF file
 	"""
 	import os
 	import errno
-	from operator import itemgetter
-	from natsort import natsorted
 	
 	headerList = []
 	seqregList = []
 	dataList = []
+	keep = _entryFilter(types, seqids, region)
 	try:
-		with open(filePath) as file:
+		with openFile(filePath) as file:
 			for line in file:
+				if keep is not None and not keep(line): continue
 				temp = line.split('\t')
 				if len(temp) == 9:
 					temp[8] = temp[8].split(';')
@@ -35,10 +191,325 @@ def load(filePath):
 		raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filePath)
 	
 	# Sorts by: seqid -> start position -> end position
-	dataList = natsorted(dataList, key=itemgetter(0,3,4))
-	seqregList = natsorted(seqregList)
+	order = SeqidOrder.fromSeqRegs(seqregList)
+	order.sort(dataList, key=lambda entry: (entry[0], int(entry[3]), int(entry[4])))
+	order.sort(seqregList, key=lambda line: (line.split()[1],))
 	return [headerList, seqregList, dataList]
 
+class GFFTable:
+	"""Columnar representation of the entries of a GFF file.
+	
+	Start and end positions are stored as integer arrays, the seqid, source, type,
+	score, strand and phase columns as categorical codes, and the attributes column
+	as raw strings that are only split when accessed.
+	"""
+	CATEGORICAL = (0, 1, 2, 5, 6, 7)
+	
+	def __init__(self):
+		from array import array
+		self.levels = {c: [] for c in self.CATEGORICAL}			# code -> value, for each categorical column
+		self.codes = {c: array('i') for c in self.CATEGORICAL}	# code of each entry, for each categorical column
+		self.starts = array('q')
+		self.ends = array('q')
+		self.rawAttributes = []
+		self._lookup = {c: {} for c in self.CATEGORICAL}
+	
+	def __len__(self):
+		return len(self.starts)
+	
+	def __getitem__(self, i):
+		return self.row(i)
+	
+	def __iter__(self):
+		return (self.row(i) for i in range(len(self)))
+	
+	def append(self, fields):
+		"""Add an entry to the table.
+		
+		:param fields: the 9 columns of a GFF line, as strings
+		:return: nothing
+		"""
+		for c in self.CATEGORICAL:
+			lookup = self._lookup[c]
+			code = lookup.get(fields[c])
+			if code is None:
+				code = lookup[fields[c]] = len(self.levels[c])
+				self.levels[c].append(fields[c])
+			self.codes[c].append(code)
+		self.starts.append(int(fields[3]))
+		self.ends.append(int(fields[4]))
+		self.rawAttributes.append(fields[8])
+	
+	def field(self, i, column):
+		"""Get a single column of an entry.
+		
+		:param i: index of the entry
+		:param column: index of the column (0-8)
+		:return: the value of the column as a string
+		"""
+		if column == 3: return str(self.starts[i])
+		elif column == 4: return str(self.ends[i])
+		elif column == 8: return self.rawAttributes[i]
+		return self.levels[column][self.codes[column][i]]
+	
+	def seqid(self, i):
+		return self.levels[0][self.codes[0][i]]
+	
+	def attributes(self, i):
+		"""Parse the attributes of an entry.
+		
+		:param i: index of the entry
+		:return: a list of 'key=value' strings
+		"""
+		return self.rawAttributes[i].rstrip('\n').split(';')
+	
+	def row(self, i):
+		"""Build a GFF-formatted entry in the same form that load() returns.
+		
+		:param i: index of the entry
+		:return: [seqid, source, ..., strand, phase, [attributes]]
+		"""
+		toReturn = [self.field(i, c) for c in range(8)]
+		toReturn.append(self.rawAttributes[i].split(';'))
+		return toReturn
+	
+	def take(self, indices):
+		"""Build a new table from a subset of entries.
+		
+		Categorical columns are re-coded, so that the new table only holds the levels its own
+		entries use (e.g. a shard of one sequence stays small when pickled to a worker process).
+		
+		:param indices: indices of the entries to keep, in the order they should appear
+		:return: a GFFTable
+		"""
+		from array import array
+		
+		table = GFFTable()
+		run = type(indices) is range and indices.step == 1		# e.g. the entries of one sequence, sliced in one step
+		for c in self.CATEGORICAL:
+			codes = self.codes[c][indices.start:indices.stop] if run else array('i', map(self.codes[c].__getitem__, indices))
+			used = sorted(set(codes))
+			levels = self.levels[c]
+			if len(used) < len(levels):
+				remap = {code: new for new, code in enumerate(used)}
+				codes = array('i', map(remap.__getitem__, codes))
+				levels = [levels[code] for code in used]
+			table.codes[c] = codes
+			table.levels[c] = list(levels)
+			table._lookup[c] = {value: code for code, value in enumerate(table.levels[c])}
+		if run:
+			table.starts = self.starts[indices.start:indices.stop]
+			table.ends = self.ends[indices.start:indices.stop]
+			table.rawAttributes = self.rawAttributes[indices.start:indices.stop]
+		else:
+			table.starts = array('q', map(self.starts.__getitem__, indices))
+			table.ends = array('q', map(self.ends.__getitem__, indices))
+			table.rawAttributes = list(map(self.rawAttributes.__getitem__, indices))
+		return table
+	
+	def ranges(self):
+		"""Generate the runs of consecutive entries that share a seqid.
+		
+		Tables built by loadTable() are sorted by seqid, so each sequence has a single run.
+		
+		:return: a generator of (seqid, start index, end index) tuples, where the end index is exclusive
+		"""
+		seqCodes = self.codes[0]
+		lo = 0
+		for i in range(1, len(self)+1):
+			if i == len(self) or seqCodes[i] != seqCodes[lo]:
+				yield (self.levels[0][seqCodes[lo]], lo, i)
+				lo = i
+	
+	def fingerprints(self):
+		"""Hash the entries of each sequence, to detect which sequences changed between two versions of a file.
+		
+		:return: a dict mapping each seqid to a hex digest of its entries
+		"""
+		import hashlib
+		
+		toReturn = {}
+		for seqid, lo, hi in self.ranges():
+			h = hashlib.blake2b(digest_size=16)
+			for c in self.CATEGORICAL:
+				levels = self.levels[c]
+				h.update('\0'.join([levels[code] for code in self.codes[c][lo:hi]]).encode())
+			h.update(self.starts[lo:hi].tobytes())
+			h.update(self.ends[lo:hi].tobytes())
+			h.update('\0'.join(self.rawAttributes[lo:hi]).encode())
+			toReturn[seqid] = h.hexdigest()
+		return toReturn
+	
+	def intervals(self, types=None):
+		"""Generate the coordinates of entries, e.g. for building an index.
+		
+		:param types: if given, only entries whose type is in types are generated
+		:return: a generator of (seqid, start, end, index) tuples
+		"""
+		seqids = self.levels[0]
+		typeLevels = self.levels[2]
+		wanted = None if types is None else set(code for code, typ in enumerate(typeLevels) if typ in types)
+		seqCodes = self.codes[0]
+		typeCodes = self.codes[2]
+		for i in range(len(self)):
+			if wanted is None or typeCodes[i] in wanted:
+				yield (seqids[seqCodes[i]], self.starts[i], self.ends[i], i)
+
+def mapShards(func, shards, workers=1):
+	"""Apply a function to each shard of a computation, optionally in a process pool.
+	
+	:param func: a module-level function that takes one shard
+	:param shards: a list of shards (e.g. the records of each sequence)
+	:param workers: number of worker processes; 1 runs serially and 0 uses every CPU (default=1)
+	:return: a generator of the results of func, in the same order as shards
+	"""
+	import os
+	
+	if workers is not None and workers <= 0: workers = os.cpu_count()
+	if workers is None or workers <= 1 or len(shards) <= 1:
+		for shard in shards: yield func(shard)
+		return
+	
+	from concurrent.futures import ProcessPoolExecutor
+	workers = min(workers, len(shards))
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		yield from pool.map(func, shards, chunksize=max(1, len(shards) // (workers*4)))	# batches many small sequences per task
+
+def mapChangedShards(func, shards, fingerprints, partialPath, workers=1):
+	"""Call func on every shard whose fingerprint changed since the last call, reusing the other results.
+	
+	Results are stored in partialPath by the first item of each shard (i.e. its seqid), once
+	every result has been generated (i.e. just before the last one is yielded).
+	
+	:param func: a module-level function that takes a single shard
+	:param shards: a list of shards, each a tuple starting with its seqid
+	:param fingerprints: a fingerprint of the inputs of each shard; any picklable value that compares equal if the inputs haven't changed
+	:param partialPath: path to the file where results are stored between calls
+	:param workers: number of processes; 0 uses every CPU (default=1)
+	:return: a generator of the results of func, in the same order as shards
+	"""
+	import os
+	import pickle
+	from Cache import VERSION
+	
+	try:
+		with open(partialPath, 'rb') as f: previous = pickle.load(f)
+		if previous.get('version') != VERSION or previous.get('func') != func.__qualname__: previous = {}
+	except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+		previous = {}
+	previous = previous.get('partials', {})
+	
+	changed = [i for i, shard in enumerate(shards) if shard[0] not in previous or previous[shard[0]][0] != fingerprints[i]]
+	print('\tRecalculating ' + str(len(changed)) + ' of ' + str(len(shards)) + ' sequences')
+	fresh = zip(changed, mapShards(func, [shards[i] for i in changed], workers))
+	partials = {}
+	nextChanged = next(fresh, None)
+	for i, shard in enumerate(shards):
+		if nextChanged is not None and nextChanged[0] == i:
+			result = nextChanged[1]
+			nextChanged = next(fresh, None)
+		else:
+			result = previous[shard[0]][1]
+		partials[shard[0]] = (fingerprints[i], result)
+		
+		# Replaces the stored results in one step
+		if i == len(shards)-1:
+			tempPath = partialPath + '.' + str(os.getpid()) + '.tmp'
+			with open(tempPath, 'wb') as f: pickle.dump({'version': VERSION, 'func': func.__qualname__, 'partials': partials}, f, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(tempPath, partialPath)
+		yield result
+
+def loadTable(filePath, types=None, seqids=None, region=None):
+	"""Load the contents of a GFF file into a columnar table, reusing a cached copy if the file hasn't changed.
+	
+	Filters are applied while the file is read, as in load().
+	
+	:param filePath: the absolute path to the GFF file
+	:param types: if given, only entries whose type is in types are loaded (default=None)
+	:param seqids: if given, only entries on these sequences are loaded (default=None)
+	:param region: if given, a (seqid, start, end) tuple; only entries that overlap it are loaded (default=None)
+	:return: [headers, sequence-regions, GFFTable], sorted in the same order as load()
+	"""
+	from Cache import cached
+	return cached(_loadTable, filePath, *_filterArgs(types, seqids, region))
+
+def _loadTable(filePath, types=None, seqids=None, region=None):
+	"""Parse and sort the contents of a GFF file into a columnar table.
+	
+	:param filePath: the absolute path to the GFF file
+	:param types: the types of entries to load, or None for every type (see load())
+	:param seqids: the sequences to load entries of, or None for every sequence
+	:param region: a (seqid, start, end) tuple that loaded entries must overlap, or None
+	:return: [headers, sequence-regions, GFFTable], sorted in the same order as load()
+	"""
+	import os
+	import errno
+	
+	headerList = []
+	seqregList = []
+	table = GFFTable()
+	keep = _entryFilter(types, seqids, region)
+	try:
+		with openFile(filePath) as file:
+			for line in file:
+				if keep is not None and not keep(line): continue
+				temp = line.split('\t')
+				if len(temp) == 9:
+					table.append(temp)
+				elif temp[0].startswith('##sequence-region'):
+					seqregList.append(line)
+				elif temp[0].startswith('#'):
+					headerList.append(line)
+				else:
+					raise AssertionError('Unknown line in GFF file: ' + line)
+	except IOError:
+		raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filePath)
+	
+	# Sorts by: seqid -> start position -> end position
+	order = SeqidOrder.fromSeqRegs(seqregList)
+	order.add(table.levels[0])
+	ranks = [order.ranks[seqid] for seqid in table.levels[0]]
+	seqCodes = table.codes[0]
+	keys = [(ranks[seqCodes[i]], table.starts[i], table.ends[i]) for i in range(len(table))]
+	if not isSorted(keys): table = table.take(sorted(range(len(table)), key=keys.__getitem__))
+	order.sort(seqregList, key=lambda line: (line.split()[1],))
+	return [headerList, seqregList, table]
+
+def _filterArgs(types, seqids, region):
+	"""Put the filters of load() in a canonical form, so equal filters share a cache entry.
+	
+	:param types: the types to load, or None
+	:param seqids: the sequences to load, or None
+	:param region: a (seqid, start, end) tuple, or None
+	:return: a tuple of (types, seqids, region)
+	"""
+	if types is not None: types = tuple(sorted(set(types)))
+	if seqids is not None: seqids = tuple(sorted(set(seqids)))
+	if region is not None: region = (region[0], int(region[1]), int(region[2]))
+	return types, seqids, region
+
+def _entryFilter(types, seqids, region):
+	"""Build a test of whether a line of a GFF file should be loaded, splitting off as few columns as possible.
+	
+	:param types: the types to load, or None
+	:param seqids: the sequences to load, or None
+	:param region: a (seqid, start, end) tuple, or None
+	:return: a function that takes a line and returns False if it should be skipped, or None if every line should be loaded
+	"""
+	if types is None and seqids is None and region is None: return None
+	types = None if types is None else set(types)
+	seqids = None if seqids is None else set(seqids)
+	
+	def keep(line):
+		if line.startswith('#'): return True
+		fields = line.split('\t', 5)
+		if len(fields) < 6: return True		# left for the parser to reject
+		if types is not None and fields[2] not in types: return False
+		if seqids is not None and fields[0] not in seqids: return False
+		if region is not None and (fields[0] != region[0] or int(fields[3]) > region[2] or int(fields[4]) < region[1]): return False
+		return True
+	return keep
+
 def writeEntry(line):
 	"""Convert a GFF-formatted entry into a string.
 	GFF-formatted entry: [seqid, source, ..., strand, phase, [attributes]]
@@ -46,111 +517,300 @@ def writeEntry(line):
 	:param line: A GFF-formatted entry
 	:return: A string representation of the GFF-formatted entry
 	"""
-	toReturn = ''
-	for item in line:
-		if type(item) is list:
-			for item2 in item: toReturn += str(item2) + ';'
-		else:
-			toReturn += str(item) + '\t'
-	return toReturn[:-1]
-
-def writeFile(filePath, header, data):
-	"""Write data to a GFF file.
+	return '\t'.join([';'.join(item) if type(item) is list else str(item) for item in line])
 
+def writeFile(filePath, header, data, memory=None, order=None):
+	"""Write data to a GFF file, sorted by sequence, start and end position and without duplicates.
+	
+	Entries are streamed: once the entries held in memory exceed the memory budget, they are
+	sorted and spilled to a temporary file, and every spilled run is merged while writing.
+	
 	:param filePath: the absolute path to the file to write to
 	:param header: the headers of the GFF file
-	:param data: the data for the file
+	:param data: the data for the file (an iterable of GFF-formatted entries, e.g. a GFFTable)
+	:param memory: approximate max size (in MB) of the entries held in memory (default=settings['sortMemory'])
+	:param order: a SeqidOrder (default=built from the sequence-regions in header)
 	:return: nothing
 	"""
 	import os
-	from natsort import natsorted
-	from itertools import groupby
+	import heapq
+	import tempfile
 	
+	budget = (settings['sortMemory'] if memory is None else memory) * 1000000
 	os.makedirs(os.path.dirname(filePath), exist_ok=True)
-	with open(filePath, 'w') as file:
-		for line in header: file.write(line)
-		data = natsorted(data)
-		dataFiltered = list(l for l,_ in groupby(data))	# removes duplicates from data
-		for line in dataFiltered: file.write(writeEntry(line))
+	if order is None: order = SeqidOrder.fromSeqRegs(header)
+	key = _entryKey(order)
+	with tempfile.TemporaryDirectory(dir=os.path.dirname(filePath) or None) as tempDir:
+		runs = []
+		lines = []
+		size = 0
+		for entry in data:
+			line = writeEntry(entry)
+			if not line.endswith('\n'): line += '\n'
+			lines.append(line)
+			size += len(line) + 100		# rough overhead of a str object and its list slot
+			if size > budget:
+				_sortLines(lines, key)
+				runs.append(os.path.join(tempDir, str(len(runs))))
+				with open(runs[-1], 'w') as run: run.writelines(lines)
+				lines = []
+				size = 0
+		_sortLines(lines, key)
+		
+		# Merges every sorted run, skipping duplicates
+		runFiles = [open(run, 'r', buffering=1 << 20) for run in runs]
+		try:
+			with openFile(filePath, 'w') as file:
+				for line in header: file.write(line)
+				previous = None
+				for line in heapq.merge(lines, *runFiles, key=key) if runFiles else lines:
+					if line != previous: file.write(line)
+					previous = line
+		finally:
+			for run in runFiles: run.close()
+
+def _entryKey(order):
+	"""Build a sort key for formatted GFF lines: natural-sort key of seqid, then start, end and the whole line.
+	
+	Seqid keys are cached per seqid and stay fixed while streaming, so sorted runs spilled
+	before a new seqid turns up still merge correctly.
+	
+	:param order: a SeqidOrder
+	:return: a function mapping a GFF line to its sort key
+	"""
+	seqidKey = order.key
+	def key(line):
+		seqid, _, _, start, end, _ = line.split('\t', 5)
+		return (seqidKey(seqid), int(start), int(end), line)
+	return key
+
+def _sortLines(lines, key):
+	"""Sort formatted GFF lines in place, unless they are already sorted.
+	
+	:param lines: a list of GFF lines
+	:param key: a sort key generated by _entryKey()
+	:return: nothing
+	"""
+	keys = [key(line) for line in lines]
+	if not isSorted(keys):
+		keys.sort()
+		lines[:] = [k[-1] for k in keys]
+
+# Per-process memos of sequence-regions, sequence labels, FASTA indexes and sequence label positions
+_seqRegs = {}
+_seqLabels = {}
+_fastaIndexes = {}
+_seqidIndexes = {}
 
-def generateSeqRegs(fastaPath):
+def generateSeqRegs(fastaPath, index=None):
 	"""Generate sequence headers from a FASTA file.
 	
+	Sequence lengths are taken from the FASTA index (see loadFastaIndex()), and the
+	result is memoized for the rest of the process.
+	
 	:param fastaPath: the absolute path to the FASTA file
+	:param index: position of the sequence label within each header, when split on '>', '|', ',' and whitespace
+		(default=asks the user, once per FASTA file)
 	:return: a list of sequence-regions (formatted as strings)
 	"""
 	import os
+	
+	labels = seqLabels(fastaPath, index)
+	stat = os.stat(fastaPath)
+	key = (os.path.abspath(fastaPath), stat.st_size, stat.st_mtime_ns, _seqidIndexes[os.path.abspath(fastaPath)])
+	if key in _seqRegs: return list(_seqRegs[key])
+	
+	# Builds the strings
+	toReturn = []
+	for label, entry in zip(labels, loadFastaIndex(fastaPath)):
+		toReturn.append('##sequence-region ' + label + ' 1 ' + str(entry[1]))
+	_seqRegs[key] = SeqidOrder(labels).sort(toReturn, key=lambda line: (line.split()[1],))
+	return list(_seqRegs[key])
+
+def seqLabels(fastaPath, index=None):
+	"""Get the label of each sequence of a FASTA file, as used for seqids in the GFF files.
+	
+	The result is memoized for the rest of the process.
+	
+	:param fastaPath: the absolute path to the FASTA file
+	:param index: position of the sequence label within each header, when split on '>', '|', ',' and whitespace
+		(default=asks the user, once per FASTA file)
+	:return: a list of labels, in the same order as the sequences of the FASTA index (see loadFastaIndex())
+	"""
+	import os
 	import errno
 	import re
-	from natsort import natsorted
 	
-	tempList = []
 	pattern = '[>\|,\s]+'
-	
 	try:
-		with open(fastaPath, 'r') as f:
-			# Prompts the user to specify the location of the sequence region name
-			s = f.readline().strip()
-			fline = re.split(pattern, s)
+		stat = os.stat(fastaPath)
+		
+		# Prompts the user to specify the location of the sequence region name
+		if index is None:
+			index = _seqidIndexes.get(os.path.abspath(fastaPath))
+		if index is None:
+			with openFile(fastaPath, 'r') as f: fline = re.split(pattern, f.readline().strip())
 			print(fline)
 			index = int(input('Index of position that contains sequence label: '))
-			tempList.append([fline[index], 0])
-			
-			# Iterates over the rest of the strings
-			for line in f:
-				if not line.startswith('>'):
-					tempList[-1][1] += len(line.strip())
-				else:
-					tempList.append([re.split(pattern, line.strip())[index], 0])
+		_seqidIndexes[os.path.abspath(fastaPath)] = index
+		
+		key = (os.path.abspath(fastaPath), stat.st_size, stat.st_mtime_ns, index)
+		if key in _seqLabels: return _seqLabels[key]
+		
+		# Labels can be taken from the indexed sequence names unless they lie past the first word of a header
+		labels = []
+		fastaIndex = loadFastaIndex(fastaPath)
+		for entry in fastaIndex:
+			tokens = re.split(pattern, '>' + entry[0])
+			if index >= len(tokens) or not tokens[index]: break
+			labels.append(tokens[index])
+		
+		# Otherwise reads the labels from the full headers
+		if len(labels) < len(fastaIndex):
+			labels = []
+			with openFile(fastaPath, 'r') as f:
+				for line in f:
+					if line.startswith('>'): labels.append(re.split(pattern, line.strip())[index])
 	except IOError:
 		raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), fastaPath)
 	
-	# Builds the strings
-	toReturn = []
-	for pair in tempList:
-		toReturn.append('##sequence-region ' + pair[0] + ' 1 ' + str(pair[1]))
-	return natsorted(toReturn)
+	_seqLabels[key] = labels
+	return labels
+
+def loadFastaIndex(fastaPath):
+	"""Load the samtools-compatible index (.fai) of a FASTA file.
+	
+	If the index doesn't exist or is older than the FASTA file, it is built in a single
+	pass and written next to the FASTA file (unless the FASTA file is compressed, as the
+	offsets then only apply to the decompressed stream). The result is memoized for the
+	rest of the process.
+	
+	:param fastaPath: the absolute path to the FASTA file
+	:return: a list of (name, length, offset, line bases, line width) tuples, one per sequence;
+		line bases and line width are 0 if the line lengths of a sequence are irregular
+	"""
+	import os
+	
+	stat = os.stat(fastaPath)
+	key = (os.path.abspath(fastaPath), stat.st_size, stat.st_mtime_ns)
+	if key in _fastaIndexes: return _fastaIndexes[key]
+	
+	# Reads an existing index
+	faiPath = fastaPath + '.fai'
+	entries = None
+	try:
+		if os.stat(faiPath).st_mtime_ns >= stat.st_mtime_ns:
+			with open(faiPath, 'r') as f:
+				entries = []
+				for line in f:
+					temp = line.rstrip('\n').split('\t')
+					entries.append((temp[0], int(temp[1]), int(temp[2]), int(temp[3]), int(temp[4])))
+	except (OSError, ValueError, IndexError):
+		entries = None
+	
+	# Otherwise builds one and writes it if the FASTA file can be indexed by samtools
+	if entries is None:
+		entries = _buildFastaIndex(fastaPath)
+		if all(entry[3] > 0 or entry[1] == 0 for entry in entries) and not isCompressed(fastaPath):
+			try:
+				with open(faiPath, 'w') as f:
+					for entry in entries: f.write('\t'.join(str(x) for x in entry) + '\n')
+			except OSError:
+				pass	# e.g. read-only genome directories
+	
+	_fastaIndexes[key] = entries
+	return entries
 
-def reformatSAM(samPath, genomePath):
+def _buildFastaIndex(fastaPath):
+	"""Scan a FASTA file for the name, length and layout of each sequence.
+	
+	:param fastaPath: the absolute path to the FASTA file
+	:return: a list of (name, length, offset, line bases, line width) tuples, one per sequence
+	"""
+	entries = []
+	offset = 0
+	current = None		# [name, length, offset, line bases, line width, reached last line]
+	with openFile(fastaPath, 'rb') as f:
+		for line in f:
+			if line.startswith(b'>'):
+				if current is not None: entries.append(tuple(current[:5]))
+				temp = line[1:].split(None, 1)
+				current = [temp[0].decode() if temp else '', 0, offset + len(line), 0, 0, False]
+			elif current is not None:
+				bases = len(line.rstrip(b'\r\n'))
+				if current[1] == 0 and not current[5]:
+					current[3] = bases
+					current[4] = len(line)
+				elif (current[5] and bases > 0) or bases > current[3] or (bases == current[3] and line.endswith(b'\n') and len(line) != current[4]):
+					current[3] = current[4] = 0		# irregular line lengths
+				if bases < current[3] or bases == 0: current[5] = True
+				current[1] += bases
+			offset += len(line)
+	if current is not None: entries.append(tuple(current[:5]))
+	return entries
+
+@Instrument.timed('reformatSAM')
+def reformatSAM(samPath, genomePath, seqidIndex=None):
 	"""Reformat a blastn-outputted SAM file to replace the 'Query_#' sequence names with the actual sequence names.
 
 	:param samPath: path to the SAM-formatted blastn file
 	:param genomePath: path to the FASTA-formatted query genome file that 'samPath' was based off of
+	:param seqidIndex: position of the sequence label within each FASTA header (default=asks the user)
 	:return: nothing
 	"""
-	import fileinput
-	import re
+	import os
 	print('Reformatting SAM file...')
 	
-	seqList = [seq.split()[1] for seq in generateSeqRegs(genomePath)]
-	seqList.insert(0, 'null')	# offsets the list by one because there doesn't exist a "Query_0"
+	names = queryNames(genomePath, seqidIndex)
 	
-	with fileinput.FileInput(samPath, inplace=True) as f:
-		pattern = r'Query_[0-9]+'
-		for line in f:
-			temp = re.search(pattern, line)
-			if temp is not None:
-				num = int(temp.group()[6:])
-				line = re.sub(pattern, seqList[num], line)
-			print(line.strip())
+	# Streams the renamed file to a temporary file (compressed like the original), then replaces the original with it
+	tempPath = samPath + '.tmp'
+	with openFile(samPath, 'r') as f, openFile(tempPath, 'w', isCompressed(samPath)) as out:
+		batch = []
+		lines = 0
+		for line in Instrument.progress(f, 'Reformatting lines'):
+			lines += 1
+			batch.append('\t'.join([names.get(field, field) for field in line.strip().split('\t')]))
+			if len(batch) >= 65536:
+				out.write('\n'.join(batch) + '\n')
+				batch = []
+		if batch: out.write('\n'.join(batch) + '\n')
+	os.replace(tempPath, samPath)
+	Instrument.count(lines)
 	
 	print('Finished!\n')
 
-def reformatGFF(gffPath, fastaPath):
+def queryNames(genomePath, seqidIndex=None):
+	"""Build a lookup table from blastn's 'Query_#' sequence names to the actual sequence names.
+	
+	:param genomePath: path to the FASTA-formatted query genome file that the blastn search was based off of
+	:param seqidIndex: position of the sequence label within each FASTA header (default=asks the user)
+	:return: a dict mapping SAM fields ('Query_#' and 'SN:Query_#') to their renamed versions
+	"""
+	names = {}
+	for i, seq in enumerate(generateSeqRegs(genomePath, seqidIndex), 1):	# there doesn't exist a "Query_0"
+		name = seq.split()[1]
+		names['Query_' + str(i)] = name
+		names['SN:Query_' + str(i)] = 'SN:' + name
+	return names
+
+@Instrument.timed('reformatGFF')
+def reformatGFF(gffPath, fastaPath, seqidIndex=None):
 	"""Reformat a GFF annotation file to a GFF3 file.
 	
 	:param gffPath: path to the GFF-formatted annotation file
 	:param fastaPath: path to the FASTA-formatted genome file that gffPath is based off of
+	:param seqidIndex: position of the sequence label within each FASTA header (default=asks the user)
 	:return: writes a GFF3-formatted file to the same directory as gffPath
 	"""
 	print('Reformatting GFF file...')
 	
-	toWritePath = gffPath + '3'
-	seqs = generateSeqRegs(fastaPath)
+	toWritePath = derivePath(gffPath, 'gff3')
+	seqs = generateSeqRegs(fastaPath, seqidIndex)
 	dataToWrite = []
 	
 	# Reformat each line of gff file
-	with open(gffPath, 'r') as gffFile:
+	with openFile(gffPath, 'r') as gffFile:
 		for line in gffFile:
 			line = line.strip().split('\t')
 			temp = ''
@@ -162,9 +822,10 @@ def reformatGFF(gffPath, fastaPath):
 			dataToWrite.append('\t'.join(line))
 			
 	# Write everything to output file
-	with open(toWritePath, 'w') as f:
+	with openFile(toWritePath, 'w') as f:
 		f.write('##gff-version 3\n')
 		for s in seqs: f.write(s + '\n')
 		for datum in dataToWrite: f.write(datum + '\n')
+	Instrument.count(len(dataToWrite))
 	
 	print('Finished!\n')
\ No newline at end of file
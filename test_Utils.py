@@ -0,0 +1,30 @@
+# =============================================================================
+# bmle
+# G4Pipeline: test_Utils.py
+# Regression tests for Utils.py
+# =============================================================================
+
+def test_writeFile_seqids_missing_from_headers(tmp_path):
+	"""Entries on seqids without a sequence-region header are written in natural order and deduplicated."""
+	from Utils import writeFile
+
+	entries = [['chr2', 'src', 'gene', 5, 9, '.', '+', '.', 'ID=a'],
+		['chr10', 'src', 'gene', 1, 4, '.', '+', '.', 'ID=b'],
+		['chr1', 'src', 'gene', 3, 8, '.', '+', '.', 'ID=c'],
+		['chr2', 'src', 'gene', 5, 9, '.', '+', '.', 'ID=a']]
+	path = str(tmp_path / 'out.gff')
+	writeFile(path, ['##gff-version 3\n'], entries)
+	with open(path) as file: seqids = [line.split('\t')[0] for line in file if not line.startswith('#')]
+	assert seqids == ['chr1', 'chr2', 'chr10']
+
+def test_writeFile_spilled_runs_with_new_seqids(tmp_path):
+	"""Runs spilled before a new seqid turns up merge in natural order."""
+	from Utils import writeFile
+
+	seqids = ['chr' + str(n) for n in range(300, 0, -1)]
+	entries = [[seqid, 'src', 'gene', 1, 2, '.', '+', '.', 'ID=' + seqid] for seqid in seqids * 2]
+	header = ['##gff-version 3\n', '##sequence-region chr5 1 10\n']
+	path = str(tmp_path / 'out.gff')
+	writeFile(path, header, entries, memory=0.01)
+	with open(path) as file: written = [line.split('\t')[0] for line in file if not line.startswith('#')]
+	assert written == ['chr' + str(n) for n in range(1, 301)]